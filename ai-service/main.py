@@ -1,22 +1,37 @@
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import ORJSONResponse, Response
 import torch
 import logging
 import os
-import requests
+import httpx
 import time as import_time
 import asyncio
-from typing import Optional
+import functools
+import itertools
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Set, Tuple
 from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 
+try:
+    import pybase64
+except ImportError:  # optional SIMD-accelerated base64
+    pybase64 = None
+    import base64
+
 # Load environment variables from .env file
 load_dotenv()
 
+# Disable TQDM progress bars completely (read by tqdm at import, so set before loading ML libraries)
+os.environ['TQDM_DISABLE'] = '1'
+
 from services.flux_service import FluxService
+from services.generation_batcher import GenerationBatcher
+from services.circuit_breaker import CircuitBreaker
 from services.eventbridge_client import send_lifecycle_event as eb_send_lifecycle, send_completion_update as eb_send_completion, send_error_update as eb_send_error, send_progress_update as eb_send_progress
-from services.mqtt_client import send_progress_update, send_completion_update, send_error_update, cleanup_mqtt
+from services.mqtt_client import send_progress_update_async, send_completion_update_async, send_error_update_async, publish_event_async, cleanup_mqtt
 from services.instance_monitor import get_instance_monitor
 from models.generation_request import GenerationRequest, GenerationResponse
 
@@ -35,7 +50,7 @@ def suppress_model_loading_logs():
     """Completely suppress verbose logging from ML libraries"""
     # Set to CRITICAL level to suppress almost everything
     for lib_name in ['transformers', 'diffusers', 'accelerate', 'torch', 'huggingface_hub', 
-                     'safetensors', 'tokenizers', 'urllib3', 'requests', 'tqdm']:
+                     'safetensors', 'tokenizers', 'urllib3', 'requests', 'httpx', 'tqdm']:
         logging.getLogger(lib_name).setLevel(logging.CRITICAL)
     
     # Suppress all existing loggers that might contain these libraries
@@ -46,23 +61,144 @@ def suppress_model_loading_logs():
 
 suppress_model_loading_logs()
 
-# Disable TQDM progress bars completely
-import os
-os.environ['TQDM_DISABLE'] = '1'
-
-# Redirect stdout/stderr during model loading to suppress binary output
-import sys
-from io import StringIO
+# Configuration is fixed for the process lifetime, so read it once
+BACKEND_URL = os.getenv('BACKEND_URL', 'http://localhost:3000')
+PROGRESS_URL = f"{BACKEND_URL}/api/internal/progress"
+MODEL_NAME = os.getenv('MODEL_NAME', 'AI model')
+INSTANCE_ID = os.getenv('EC2_INSTANCE_ID', 'unknown')
+INSTANCE_TYPE = os.getenv('EC2_INSTANCE_TYPE', 'unknown')
 
 # Global variables
 flux_service: Optional[FluxService] = None
+batcher: Optional[GenerationBatcher] = None
+
+# Blocking EventBridge calls run here instead of on the event loop (MQTT has its own publish pool)
+EVENT_IO_WORKERS = 4
+_event_executor = ThreadPoolExecutor(max_workers=EVENT_IO_WORKERS, thread_name_prefix="event-io")
+
+# Minimum seconds between progress updates for one job (terminal updates always go out)
+PROGRESS_MIN_INTERVAL = float(os.getenv('PROGRESS_MIN_INTERVAL', '0.2'))
+
+# Progress goes to the first healthy channel: MQTT, then EventBridge, then HTTP
+PROGRESS_BREAKER_FAILURES = int(os.getenv('PROGRESS_BREAKER_FAILURES', '3'))
+PROGRESS_BREAKER_RESET = float(os.getenv('PROGRESS_BREAKER_RESET', '30'))
+mqtt_breaker = CircuitBreaker("MQTT progress", PROGRESS_BREAKER_FAILURES, PROGRESS_BREAKER_RESET)
+eventbridge_breaker = CircuitBreaker("EventBridge progress", PROGRESS_BREAKER_FAILURES, PROGRESS_BREAKER_RESET)
+
+# In-flight publish_progress tasks, referenced until they finish
+_progress_tasks: Set[asyncio.Task] = set()
+
+async def publish_progress(job_id: str, user_id: str, progress: int, message: str, seq: int):
+    """Deliver a progress update over the first channel that accepts it"""
+    loop = asyncio.get_running_loop()
+    
+    # Primary: Send via MQTT (real-time)
+    if mqtt_breaker.allow():
+        delivered = await send_progress_update_async(job_id, user_id, progress, message, seq)
+        mqtt_breaker.record(delivered)
+        if delivered:
+            return
+    
+    # Secondary: Send via EventBridge (reliable). Progress is batched, so True means accepted for the
+    # next flush (failed flushes retry once); False means the channel is failing right now.
+    if eventbridge_breaker.allow():
+        delivered = await loop.run_in_executor(
+            _event_executor, eb_send_progress, job_id, user_id, progress, message, seq
+        )
+        eventbridge_breaker.record(delivered)
+        if delivered:
+            return
+    
+    # Fallback to HTTP for backward compatibility (optional)
+    try:
+        await app.state.http.post(PROGRESS_URL, json={
+            "user_id": user_id,
+            "job_id": job_id,
+            "progress": progress,
+            "message": message,
+            "seq": seq
+        })
+    except Exception as e:
+        logger.debug(f"HTTP progress fallback failed (non-critical): {e}")
+
+# How /generate returns the image: "data_url" (inline base64) or "url" (GET /generate/{image_id}/image)
+IMAGE_DELIVERY = os.getenv('IMAGE_DELIVERY', 'data_url')
+IMAGE_CACHE_TTL = float(os.getenv('IMAGE_CACHE_TTL', '600'))
+IMAGE_CACHE_MAX_ENTRIES = max(1, int(os.getenv('IMAGE_CACHE_MAX_ENTRIES', '256')))
+
+# image_id -> (expires_at, image_bytes, mime_type) for images served by URL
+_image_cache: Dict[str, Tuple[float, bytes, str]] = {}
+
+def cache_image(image_bytes: bytes, mime_type: str) -> str:
+    """Keep encoded image bytes until IMAGE_CACHE_TTL expires, holding at most IMAGE_CACHE_MAX_ENTRIES.
+    
+    Returns the unguessable id to fetch it by. Keying on job_id would let callers that share one
+    (every request without a job_id is "direct") overwrite and read each other's images.
+    """
+    now = import_time.monotonic()
+    image_id = uuid.uuid4().hex
+    # Every entry gets the same TTL, so insertion order is expiry order: prune from the oldest end only
+    while _image_cache:
+        oldest_id = next(iter(_image_cache))
+        if _image_cache[oldest_id][0] > now and len(_image_cache) < IMAGE_CACHE_MAX_ENTRIES:
+            break
+        del _image_cache[oldest_id]
+    _image_cache[image_id] = (now + IMAGE_CACHE_TTL, image_bytes, mime_type)
+    return image_id
+
+@functools.lru_cache(maxsize=None)
+def probe_gpu() -> Tuple[bool, int]:
+    """GPU availability and count; neither changes during the process lifetime"""
+    gpu_available = torch.cuda.is_available()
+    return gpu_available, torch.cuda.device_count() if gpu_available else 0
+
+def encode_image_data_url(image_bytes: bytes, mime_type: str) -> str:
+    """Build an image data URL, using pybase64 when it is installed"""
+    if pybase64 is not None:
+        encoded = pybase64.b64encode_as_string(image_bytes)
+    else:
+        encoded = base64.b64encode(image_bytes).decode()
+    return f"data:{mime_type};base64,{encoded}"
+
+def generation_response(job_id: str, status: str, message: str,
+                        image_url: Optional[str] = None, error: Optional[str] = None) -> ORJSONResponse:
+    """Serialize a GenerationResponse payload directly.
+    
+    Returning a Response skips FastAPI's response_model round-trip (model_dump,
+    re-validation, jsonable_encoder), which would copy a multi-MB data URL several times.
+    GenerationResponse still documents the shape in OpenAPI.
+    """
+    return ORJSONResponse({
+        "job_id": job_id,
+        "status": status,
+        "message": message,
+        "image_url": image_url,
+        "error": error
+    })
+
+async def publish_result_event(job_id: str, user_id: str, image_url: Optional[str] = None, error: Optional[str] = None):
+    """Send a job's completion (or, with error, failure) event via MQTT and EventBridge off the event loop"""
+    loop = asyncio.get_running_loop()
+    if error is None:
+        sends = [
+            send_completion_update_async(job_id, user_id, image_url),
+            loop.run_in_executor(_event_executor, eb_send_completion, job_id, user_id, image_url)
+        ]
+    else:
+        sends = [
+            send_error_update_async(job_id, user_id, error),
+            loop.run_in_executor(_event_executor, eb_send_error, job_id, user_id, error)
+        ]
+    for outcome in await asyncio.gather(*sends, return_exceptions=True):
+        if isinstance(outcome, Exception):
+            logger.warning(f"Failed to send {'completion' if error is None else 'error'} event: {outcome}")
 
 async def send_service_event(event_type: str, data: dict):
     """Send AI service lifecycle events via EventBridge and MQTT"""
     try:
         # Send via EventBridge only (lifecycle events don't need MQTT progress format)
-        await asyncio.get_event_loop().run_in_executor(
-            None, 
+        await asyncio.get_running_loop().run_in_executor(
+            _event_executor, 
             eb_send_lifecycle, 
             f"AI Service {event_type.replace('_', ' ').title()}", 
             data
@@ -70,16 +206,11 @@ async def send_service_event(event_type: str, data: dict):
         
         # For MQTT, send as raw message if needed
         try:
-            from services.mqtt_client import get_mqtt_client
-            client = get_mqtt_client()
-            if client:
-                topic = f"fluxer/ai/lifecycle/{event_type}"
-                payload = {
-                    'event_type': event_type,
-                    'data': data,
-                    'timestamp': import_time.time()
-                }
-                client._publish_message(topic, payload)
+            await publish_event_async(f"fluxer/ai/lifecycle/{event_type}", {
+                'event_type': event_type,
+                'data': data,
+                'timestamp': import_time.time()
+            })
         except Exception as mqtt_error:
             logger.debug(f"MQTT lifecycle event failed (non-critical): {mqtt_error}")
         
@@ -89,10 +220,14 @@ async def send_service_event(event_type: str, data: dict):
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global flux_service
+    global flux_service, batcher
     
     # Initialize services
     logger.info("Initializing AI services...")
+    app.state.http = httpx.AsyncClient(
+        timeout=httpx.Timeout(1.0, connect=0.3),
+        limits=httpx.Limits(max_keepalive_connections=32)
+    )
     
     try:
         # Start instance monitoring
@@ -100,9 +235,8 @@ async def lifespan(app: FastAPI):
         await instance_monitor.start_monitoring()
         
         # Send startup event
-        instance_id = os.getenv('EC2_INSTANCE_ID', 'unknown')
         await send_service_event("ai_service_starting", {
-            "instance_id": instance_id,
+            "instance_id": INSTANCE_ID,
             "model_name": os.getenv('MODEL_NAME', 'unknown'),
             "timestamp": import_time.time()
         })
@@ -110,15 +244,24 @@ async def lifespan(app: FastAPI):
         # Initialize Flux service with eager loading
         flux_service = FluxService()
         
-        # Eager load the model
+        # Long diffusion calls get their own thread so they never queue behind other executor work
+        app.state.gpu_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gpu")
+        flux_service.set_executor(app.state.gpu_executor)
+        # Started before the model loads so the lazy-load path in /generate can queue work too
+        batcher = GenerationBatcher(flux_service)
+        batcher.start()
+        
+        # Eager load the model on the GPU executor: compile warmup must run on the thread that later
+        # generates (CUDA graph trees are thread-local), and it must not block the event loop
+        await asyncio.to_thread(flux_service.prefetch_weights)
         logger.info("Eager loading FLUX model...")
-        success = flux_service.load_model()
+        success = await flux_service.initialize()
         
         if success:
             logger.info("FLUX model loaded successfully - AI service ready!")
             # Send ready event
             await send_service_event("ai_service_ready", {
-                "instance_id": instance_id,
+                "instance_id": INSTANCE_ID,
                 "model_name": os.getenv('MODEL_NAME', 'unknown'), 
                 "model_loaded": True,
                 "timestamp": import_time.time()
@@ -132,7 +275,7 @@ async def lifespan(app: FastAPI):
         logger.error(f"Failed to initialize AI service: {e}")
         # Send error event
         await send_service_event("ai_service_error", {
-            "instance_id": instance_id,
+            "instance_id": INSTANCE_ID,
             "error": str(e),
             "timestamp": import_time.time()
         })
@@ -144,23 +287,28 @@ async def lifespan(app: FastAPI):
     
     # Cleanup
     logger.info("Shutting down AI services...")
+    await batcher.stop()
     
     # Notify instance monitor about shutdown
     instance_monitor = get_instance_monitor()
     await instance_monitor.send_service_stopping()
-    instance_monitor.stop_monitoring()
+    await instance_monitor.stop_monitoring()
     
     # Send shutdown event
     await send_service_event("ai_service_stopping", {
-        "instance_id": instance_id,
+        "instance_id": INSTANCE_ID,
         "timestamp": import_time.time()
     })
     cleanup_mqtt()
+    _event_executor.shutdown(wait=False)
+    app.state.gpu_executor.shutdown(wait=False)
+    await app.state.http.aclose()
 
 app = FastAPI(
     title="Fluxer AI Service", 
-    description=f"AI image generation service using {os.getenv('MODEL_NAME', 'AI model')}",
+    description=f"AI image generation service using {MODEL_NAME}",
     version="1.0.0",
+    default_response_class=ORJSONResponse,
     lifespan=lifespan
 )
 
@@ -175,15 +323,13 @@ app.add_middleware(
 
 @app.get("/")
 async def root():
-    model_name = os.getenv('MODEL_NAME', 'AI model')
-    return {"message": f"Fluxer AI Service - {model_name}", "status": "running"}
+    return {"message": f"Fluxer AI Service - {MODEL_NAME}", "status": "running"}
 
 @app.get("/health")
 async def health_check():
     try:
-        # Check GPU availability
-        gpu_available = torch.cuda.is_available()
-        gpu_count = torch.cuda.device_count() if gpu_available else 0
+        # Check GPU availability (probed once, liveness checks hit this every few seconds)
+        gpu_available, gpu_count = probe_gpu()
         
         if gpu_available:
             device = "cuda" 
@@ -194,10 +340,6 @@ async def health_check():
             compute_available = True
             compute_count = 1
         
-        model_name = os.getenv('MODEL_NAME', 'AI model')
-        instance_id = os.getenv('EC2_INSTANCE_ID', 'unknown')
-        instance_type = os.getenv('EC2_INSTANCE_TYPE', 'unknown')
-        
         return {
             "status": "healthy",
             "device": device,
@@ -206,9 +348,9 @@ async def health_check():
             "compute_available": compute_available,
             "compute_count": compute_count,
             "model_loaded": flux_service is not None and flux_service.is_loaded,
-            "model_name": model_name,
-            "instance_id": instance_id,
-            "instance_type": instance_type,
+            "model_name": MODEL_NAME,
+            "instance_id": INSTANCE_ID,
+            "instance_type": INSTANCE_TYPE,
             "eager_loading": True,  # Indicate this service uses eager loading
             "startup_time": import_time.time()
         }
@@ -223,10 +365,7 @@ async def ping():
     return {"status": "ok"}
 
 @app.post("/generate", response_model=GenerationResponse)
-async def generate_image(
-    request: GenerationRequest,
-    background_tasks: BackgroundTasks
-):
+async def generate_image(request: GenerationRequest):
     if not flux_service:
         raise HTTPException(status_code=503, detail="Flux service not initialized")
     
@@ -235,42 +374,46 @@ async def generate_image(
         if not flux_service.is_loaded:
             await flux_service.initialize()
         
-        # Create progress callback that sends updates via MQTT and EventBridge
+        # Create progress callback that sends updates via MQTT and EventBridge.
+        # FluxService calls it on the event loop (steps are polled there), so the send is just scheduled.
+        last_sent_at = 0.0
+        last_progress = -1
+        # Channels may deliver out of order; consumers keep the highest seq per job
+        sequence = itertools.count(1)
+        
         def progress_callback(progress: int, message: str):
-            try:
-                # Primary: Send via MQTT (real-time)
-                send_progress_update(request.job_id, request.user_id, progress, message)
-                
-                # Secondary: Send via EventBridge (reliable)
-                eb_send_progress(request.job_id, request.user_id, progress, message)
-                
-                # Fallback to HTTP for backward compatibility (optional)
-                try:
-                    backend_url = os.getenv('BACKEND_URL', 'http://localhost:3000')
-                    requests.post(f"{backend_url}/api/internal/progress", json={
-                        "user_id": request.user_id,
-                        "job_id": request.job_id,
-                        "progress": progress,
-                        "message": message
-                    }, timeout=1)
-                except:
-                    pass  # Ignore HTTP fallback errors
-            except Exception as e:
-                logger.warning(f"Failed to send progress update: {e}")
+            nonlocal last_sent_at, last_progress
+            
+            # Coalesce per-step updates: drop repeats and anything faster than PROGRESS_MIN_INTERVAL
+            now = import_time.monotonic()
+            if progress < 100 and (progress == last_progress or now - last_sent_at < PROGRESS_MIN_INTERVAL):
+                return
+            last_sent_at = now
+            last_progress = progress
+            
+            task = asyncio.create_task(
+                publish_progress(request.job_id, request.user_id, progress, message, next(sequence))
+            )
+            # The loop only keeps weak references to tasks
+            _progress_tasks.add(task)
+            task.add_done_callback(_progress_tasks.discard)
         
-        result = await flux_service.generate_image(request.model_dump(), progress_callback)
+        result = await batcher.submit(request, progress_callback)
         
         if result["status"] == "completed":
-            image_url = f"data:image/png;base64,{result['image_data']}"
+            if IMAGE_DELIVERY == "url":
+                image_id = cache_image(result["image_bytes"], result["mime_type"])
+                image_url = f"/generate/{image_id}/image"
+            else:
+                # Multi-MB base64 encode stays off the event loop
+                image_url = await asyncio.to_thread(encode_image_data_url, result["image_bytes"], result["mime_type"])
             
-            # Send completion event via MQTT and EventBridge (without image data)
-            try:
-                send_completion_update(request.job_id, request.user_id)
-                eb_send_completion(request.job_id, request.user_id)
-            except Exception as e:
-                logger.warning(f"Failed to send completion event: {e}")
+            # Send completion event via MQTT and EventBridge (without image data;
+            # only the short URL reference when images are served by URL)
+            image_ref = image_url if IMAGE_DELIVERY == "url" else None
+            await publish_result_event(request.job_id, request.user_id, image_url=image_ref)
             
-            return GenerationResponse(
+            return generation_response(
                 job_id=request.job_id,
                 status="completed",
                 message="Image generated successfully",
@@ -280,39 +423,49 @@ async def generate_image(
             error_message = result.get("error", "Image generation failed")
             
             # Send error event via MQTT and EventBridge
-            try:
-                send_error_update(request.job_id, request.user_id, error_message)
-                eb_send_error(request.job_id, request.user_id, error_message)
-            except Exception as e:
-                logger.warning(f"Failed to send error event: {e}")
+            await publish_result_event(request.job_id, request.user_id, error=error_message)
             
-            return GenerationResponse(
+            return generation_response(
                 job_id=request.job_id,
                 status="failed", 
                 message="Image generation failed",
                 error=error_message
             )
+    except asyncio.QueueFull:
+        # Backpressure, not a job failure: the caller can retry once the queue drains
+        logger.warning(f"Generation queue full, refusing job {request.job_id}")
+        raise HTTPException(status_code=503, detail="Generation queue is full, retry later")
     except Exception as e:
         logger.error(f"Error generating image: {e}")
         
         # Send error event via MQTT and EventBridge
-        try:
-            send_error_update(request.job_id, request.user_id, str(e))
-            eb_send_error(request.job_id, request.user_id, str(e))
-        except Exception as event_error:
-            logger.warning(f"Failed to send error event: {event_error}")
+        await publish_result_event(request.job_id, request.user_id, error=str(e))
         
         raise HTTPException(status_code=500, detail="Failed to generate image")
 
+@app.get("/generate/{image_id}/image")
+async def get_generated_image(image_id: str):
+    entry = _image_cache.get(image_id)
+    if entry is None or entry[0] <= import_time.monotonic():
+        raise HTTPException(status_code=404, detail="Image not found or expired")
+    
+    return Response(content=entry[1], media_type=entry[2])
+
 # Job status is now handled by backend through SQS
 # No need for job status endpoint in AI service
 
 if __name__ == "__main__":
     import uvicorn
+    # Each worker process loads its own copy of the model, so keep WORKERS=1
+    # unless the GPU has room for several pipelines
     uvicorn.run(
-        app,
+        "main:app",
         host="0.0.0.0",
         port=8000,
+        # "auto" picks uvloop and httptools (uvicorn[standard]) when installed, asyncio/h11 otherwise
+        loop="auto",
+        http="auto",
+        workers=int(os.getenv("WORKERS", "1")),
         log_level="info",
         reload=False
-    )
\ No newline at end of file
+    )
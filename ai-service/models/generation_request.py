@@ -1,17 +1,33 @@
-from pydantic import BaseModel, Field
-from typing import Optional
+from pydantic import BaseModel, Field, model_validator
+from typing import Literal, Optional
+import os
+
+# Discrete sizes let the model keep a warm kernel/compile cache per shape
+ImageDimension = Literal[256, 384, 512, 640, 768, 896, 1024]
+
+# Upper bound on width * height per request; caps peak VRAM per job. The default admits 1024x1024, the
+# frontend's default size; small-GPU deployments lower it (e.g. 524288 for 1024x512)
+MAX_PIXELS = int(os.getenv("MAX_PIXELS", str(1024 * 1024)))
 
 class GenerationRequest(BaseModel):
     user_id: str
     job_id: Optional[str] = Field(default="direct")
     prompt: str = Field(..., min_length=1, max_length=1000)
-    width: int = Field(default=512, ge=256, le=1024)
-    height: int = Field(default=512, ge=256, le=1024)
+    width: ImageDimension = 512
+    height: ImageDimension = 512
     guidance_scale: float = Field(default=7.5, ge=1.0, le=20.0)
-    num_inference_steps: int = Field(default=50, ge=10, le=100)
+    # FLUX.1-dev's reference setting; the service may cap it further (MAX_INFERENCE_STEPS)
+    num_inference_steps: int = Field(default=28, ge=10, le=100)
     seed: Optional[int] = Field(default=None, ge=0)
 
+    @model_validator(mode="after")
+    def check_pixel_budget(self) -> "GenerationRequest":
+        if self.width * self.height > MAX_PIXELS:
+            raise ValueError(f"width * height must not exceed {MAX_PIXELS} pixels")
+        return self
+
     model_config = {
+        "extra": "forbid",
         "json_schema_extra": {
             "example": {
                 "user_id": "user123",
@@ -19,7 +35,7 @@ class GenerationRequest(BaseModel):
                 "width": 512,
                 "height": 512,
                 "guidance_scale": 7.5,
-                "num_inference_steps": 50,
+                "num_inference_steps": 28,
                 "seed": 42
             }
         }
@@ -30,4 +46,7 @@ class GenerationResponse(BaseModel):
     status: str
     message: str
     image_url: Optional[str] = None
-    error: Optional[str] = None
\ No newline at end of file
+    error: Optional[str] = None
+
+# Build the request schema once at import instead of on the first /docs hit
+GenerationRequest.model_json_schema()
\ No newline at end of file
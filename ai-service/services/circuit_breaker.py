@@ -0,0 +1,37 @@
+import logging
+import time
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+class CircuitBreaker:
+    """Skips a failing delivery channel for a cool-down period after repeated failures"""
+
+    def __init__(self, name: str, failure_threshold: int = 3, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.open_until: Optional[float] = None
+
+    def allow(self) -> bool:
+        """Whether the channel should be tried right now"""
+        if self.open_until is None:
+            return True
+        if time.monotonic() >= self.open_until:
+            # Cool-down over: let the next call probe the channel again
+            self.open_until = None
+            return True
+        return False
+
+    def record(self, success: bool):
+        """Record the outcome of a call through the channel"""
+        if success:
+            self.failures = 0
+            return
+
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            self.failures = 0
+            self.open_until = time.monotonic() + self.reset_timeout
+            logger.warning(f"{self.name} failed {self.failure_threshold} times, skipping it for {self.reset_timeout}s")
@@ -1,65 +1,163 @@
 import boto3
-import json
+import orjson
+from botocore.config import Config
 import logging
 import os
-from datetime import datetime
-from typing import Optional
+import threading
+from datetime import datetime, timezone
+from typing import List, Optional, Tuple
 
 logger = logging.getLogger(__name__)
 
+AWS_REGION = os.getenv('AWS_REGION', 'eu-west-1')
+EVENT_BUS_NAME = os.getenv('EVENTBRIDGE_BUS_NAME', 'fluxer-ai-events')
+
+# One session per process; the client it builds is thread-safe and keeps its connection pool warm
+_SESSION = boto3.Session()
+_CLIENT_CONFIG = Config(
+    max_pool_connections=50,
+    retries={'mode': 'adaptive', 'max_attempts': 3},
+    tcp_keepalive=True,
+    connect_timeout=2,
+    read_timeout=5
+)
+
+# put_events accepts at most 10 entries per request
+MAX_ENTRIES_PER_REQUEST = 10
+
+# Attempts per entry (the first send plus one retry on the next flush) before it is dropped
+MAX_SEND_ATTEMPTS = 2
+
+# Seconds progress events wait in the buffer so several share one put_events call
+FLUSH_INTERVAL = float(os.getenv('EVENTBRIDGE_FLUSH_INTERVAL', '0.1'))
+
 class EventBridgeClient:
     """Client for sending events to AWS EventBridge"""
     
     def __init__(self):
-        self.client = boto3.client('events', region_name=os.getenv('AWS_REGION', 'eu-west-1'))
-        self.event_bus_name = os.getenv('EVENTBRIDGE_BUS_NAME', 'fluxer-ai-events')
+        self.client = _SESSION.client('events', region_name=AWS_REGION, config=_CLIENT_CONFIG)
+        self.event_bus_name = EVENT_BUS_NAME
+        
+        # (entry, failed attempts) not yet sent, flushed by a timer or by the next immediate event
+        self._buffer: List[Tuple[dict, int]] = []
+        self._buffer_lock = threading.Lock()
+        self._flush_timer: Optional[threading.Timer] = None
+        # Whether the most recent flush got every entry through
+        self._healthy = True
         logger.info(f"EventBridge client initialized with bus: {self.event_bus_name}")
     
-    def _send_event(self, detail_type: str, detail: dict) -> bool:
-        """Send event to EventBridge"""
+    def _entry(self, detail_type: str, detail: dict) -> dict:
+        """Build a put_events entry"""
+        return {
+            'Source': 'fluxer.ai-service',
+            'DetailType': detail_type,
+            'Detail': orjson.dumps(detail, option=orjson.OPT_UTC_Z).decode(),
+            'EventBusName': self.event_bus_name
+        }
+    
+    def _put_entries(self, entries: List[dict]) -> List[int]:
+        """Send up to MAX_ENTRIES_PER_REQUEST entries in one put_events call; returns the indices that failed"""
         try:
-            response = self.client.put_events(
-                Entries=[
-                    {
-                        'Source': 'fluxer.ai-service',
-                        'DetailType': detail_type,
-                        'Detail': json.dumps(detail),
-                        'EventBusName': self.event_bus_name
-                    }
-                ]
-            )
+            response = self.client.put_events(Entries=entries)
             
             if response['FailedEntryCount'] > 0:
-                logger.error(f"Failed to send event: {response['Entries']}")
-                return False
-                
-            event_id = response['Entries'][0].get('EventId')
-            logger.info(f"Event sent successfully: {detail_type}, EventId: {event_id}")
-            return True
+                logger.error(f"Failed to send {response['FailedEntryCount']} event(s): {response['Entries']}")
+                return [index for index, result in enumerate(response['Entries']) if 'ErrorCode' in result]
+            
+            logger.info(f"Sent {len(entries)} event(s): {', '.join(entry['DetailType'] for entry in entries)}")
+            return []
             
         except Exception as e:
-            logger.error(f"Error sending event to EventBridge: {e}")
-            return False
+            logger.error(f"Error sending events to EventBridge: {e}")
+            return list(range(len(entries)))
+    
+    def _schedule_flush(self):
+        """Start the flush timer unless one is pending; caller holds _buffer_lock"""
+        if self._flush_timer is None:
+            self._flush_timer = threading.Timer(FLUSH_INTERVAL, self.flush)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+    
+    def flush(self) -> bool:
+        """Send all buffered entries now; entries that fail are re-queued once before being dropped"""
+        with self._buffer_lock:
+            pending, self._buffer = self._buffer, []
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+        
+        retry: List[Tuple[dict, int]] = []
+        dropped = 0
+        for start in range(0, len(pending), MAX_ENTRIES_PER_REQUEST):
+            batch = pending[start:start + MAX_ENTRIES_PER_REQUEST]
+            for index in self._put_entries([entry for entry, _ in batch]):
+                entry, attempts = batch[index]
+                if attempts + 1 < MAX_SEND_ATTEMPTS:
+                    retry.append((entry, attempts + 1))
+                else:
+                    dropped += 1
+        
+        if dropped:
+            logger.error(f"Dropped {dropped} event(s) after {MAX_SEND_ATTEMPTS} failed attempts")
+        if retry:
+            with self._buffer_lock:
+                # Ahead of anything queued meanwhile, so events keep their order
+                self._buffer[:0] = retry
+                self._schedule_flush()
+        
+        self._healthy = not retry and not dropped
+        return self._healthy
+    
+    def _enqueue(self, detail_type: str, detail: dict) -> bool:
+        """Buffer an event for a batched send.
+        
+        Returns True once the event is accepted for the next flush, not when it is delivered. While the
+        last flush failed, the event is sent right away instead, and the result is whether it got through.
+        """
+        if not self._healthy:
+            return self._send_event(detail_type, detail)
+        
+        with self._buffer_lock:
+            self._buffer.append((self._entry(detail_type, detail), 0))
+            full = len(self._buffer) >= MAX_ENTRIES_PER_REQUEST
+            if not full:
+                self._schedule_flush()
+        
+        if full:
+            self.flush()
+        return True
+    
+    def _send_event(self, detail_type: str, detail: dict) -> bool:
+        """Send event to EventBridge immediately, together with any buffered events before it"""
+        with self._buffer_lock:
+            self._buffer.append((self._entry(detail_type, detail), 0))
+        return self.flush()
     
-    def send_progress_event(self, job_id: str, user_id: str, progress: int, message: str) -> bool:
+    def send_progress_event(self, job_id: str, user_id: str, progress: int, message: str, seq: Optional[int] = None) -> bool:
         """Send progress update event"""
         detail = {
             'jobId': job_id,
             'userId': user_id,
             'progress': progress,
             'message': message,
-            'timestamp': datetime.utcnow().isoformat()
+            'timestamp': datetime.now(timezone.utc)
         }
-        return self._send_event('AI Generation Progress', detail)
+        if seq is not None:
+            detail['seq'] = seq
+        # Progress is frequent and superseded quickly: batch it instead of one round-trip per event
+        return self._enqueue('AI Generation Progress', detail)
     
-    def send_completion_event(self, job_id: str, user_id: str) -> bool:
+    def send_completion_event(self, job_id: str, user_id: str, image_url: Optional[str] = None) -> bool:
         """Send completion event (without image data)"""
         detail = {
             'jobId': job_id,
             'userId': user_id,
             'status': 'completed',
-            'timestamp': datetime.utcnow().isoformat()
+            'timestamp': datetime.now(timezone.utc)
         }
+        if image_url:
+            # Short reference only, never a data URL (EventBridge caps events at 256 KB)
+            detail['imageUrl'] = image_url
         return self._send_event('AI Generation Completed', detail)
     
     def send_error_event(self, job_id: str, user_id: str, error: str) -> bool:
@@ -68,7 +166,7 @@ class EventBridgeClient:
             'jobId': job_id,
             'userId': user_id,
             'error': error,
-            'timestamp': datetime.utcnow().isoformat()
+            'timestamp': datetime.now(timezone.utc)
         }
         return self._send_event('AI Generation Failed', detail)
 
@@ -82,15 +180,17 @@ def get_eventbridge_client() -> EventBridgeClient:
         eventbridge_client = EventBridgeClient()
     return eventbridge_client
 
-def send_progress_update(job_id: str, user_id: str, progress: int, message: str) -> None:
-    """Convenience function to send progress update"""
+def send_progress_update(job_id: str, user_id: str, progress: int, message: str, seq: Optional[int] = None) -> bool:
+    """Convenience function to send progress update; returns whether it was accepted (see EventBridgeClient._enqueue)"""
     try:
         client = get_eventbridge_client()
-        success = client.send_progress_event(job_id, user_id, progress, message)
+        success = client.send_progress_event(job_id, user_id, progress, message, seq)
         if not success:
             logger.warning(f"Failed to send progress update for job {job_id}")
+        return success
     except Exception as e:
         logger.error(f"Error in send_progress_update: {e}")
+        return False
 
 def send_lifecycle_event(detail_type: str, detail: dict) -> None:
     """Convenience function to send AI service lifecycle events"""
@@ -102,11 +202,11 @@ def send_lifecycle_event(detail_type: str, detail: dict) -> None:
     except Exception as e:
         logger.error(f"Error in send_lifecycle_event: {e}")
 
-def send_completion_update(job_id: str, user_id: str) -> None:
+def send_completion_update(job_id: str, user_id: str, image_url: Optional[str] = None) -> None:
     """Convenience function to send completion update (without image data)"""
     try:
         client = get_eventbridge_client()
-        success = client.send_completion_event(job_id, user_id)
+        success = client.send_completion_event(job_id, user_id, image_url)
         if not success:
             logger.warning(f"Failed to send completion update for job {job_id}")
     except Exception as e:
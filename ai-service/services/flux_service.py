@@ -1,123 +1,321 @@
+import asyncio
+import functools
 import torch
 import logging
 import os
+import time
+from collections import OrderedDict
 from diffusers import FluxPipeline
 from PIL import Image
 import io
-import base64
-from typing import Optional, Dict, Any
-from huggingface_hub import login
+import json
+from concurrent.futures import Executor
+from typing import Optional, Dict, Any, List, Callable, Set, Tuple, Union
+from huggingface_hub import snapshot_download
+from models.generation_request import GenerationRequest, MAX_PIXELS
 
 logger = logging.getLogger(__name__)
 
+# The allocator reads this on the first CUDA allocation, so it must be set before any tensor
+# reaches the GPU; expandable segments stop varying activation shapes from fragmenting memory
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True,max_split_size_mb:512")
+
+# Resolved once at import; neither the GPU nor the configuration changes while the process runs
+DEVICE = "neuron" if os.getenv("DEVICE_TYPE") == "neuron" else "cuda" if torch.cuda.is_available() else "cpu"
+MODEL_NAME = os.getenv("MODEL_NAME", "black-forest-labs/FLUX.1-dev")
+# Local snapshot of MODEL_NAME (`huggingface-cli download --local-dir`); loaded without any Hub requests
+MODEL_PATH = os.getenv("MODEL_PATH") or None
+CUDA_MEM_FRACTION = os.getenv("CUDA_MEM_FRACTION")
+FLUX_QUANTIZE = os.getenv("FLUX_QUANTIZE", "auto").lower()
+CPU_OFFLOAD = os.getenv("CPU_OFFLOAD", "auto").lower()
+TORCH_COMPILE = os.getenv("TORCH_COMPILE", "enable") == "enable"
+COMPILE_WARMUP_SHAPES = os.getenv("COMPILE_WARMUP_SHAPES", "512x512,1024x1024")
+ATTENTION_SLICING = os.getenv("ATTENTION_SLICING", "auto").lower()
+
+# Inferentia2: NEURON_MODEL_PATH holds one `optimum-cli export neuron` directory per WxH bucket
+NEURON_MODEL_PATH = os.getenv("NEURON_MODEL_PATH", "/opt/neuron/flux_neuron")
+NEURON_IMAGE_SIZES = sorted(
+    (tuple(int(value) for value in size.strip().split("x")) for size in os.getenv("NEURON_IMAGE_SIZES", "512x512").split(",")),
+    key=lambda size: size[0] * size[1]
+)
+
+# FLUX_QUANTIZE values -> torchao quantization configs; fp8 runs the matmuls themselves in e4m3
+QUANTIZATION_CONFIGS = {
+    "int8": "int8_weight_only",
+    "int4": "int4_weight_only",
+    "fp8": "float8_dynamic_activation_float8_weight",
+}
+
+# Output encoding: png (lossless, what the backend stores by default) or webp (several times faster and smaller)
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "png").lower()
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "90"))
+# zlib level for PNG: 1 costs about half the CPU of the default 6 and barely grows noisy diffusion output
+PNG_COMPRESS_LEVEL = int(os.getenv("PNG_COMPRESS_LEVEL", "1"))
+
+# Text-encoder outputs kept per prompt; entries are dropped early when free VRAM runs low
+PROMPT_CACHE_SIZE = int(os.getenv("PROMPT_CACHE_SIZE", "256"))
+PROMPT_CACHE_MIN_FREE_MB = int(os.getenv("PROMPT_CACHE_MIN_FREE_MB", "2048"))
+
+# Hard cap on diffusion steps per job; wall time grows linearly with steps
+MAX_INFERENCE_STEPS = int(os.getenv("MAX_INFERENCE_STEPS", "50"))
+
+# FLUX.1-schnell is timestep-distilled: a few steps, no guidance, 256 T5 tokens
+SCHNELL_MAX_STEPS = 4
+SCHNELL_MAX_SEQUENCE_LENGTH = 256
+
+# GPUs up to this size get attention/VAE slicing under ATTENTION_SLICING=auto
+SLICING_MAX_VRAM_BYTES = 16 * 1024 ** 3
+
+# Free VRAM kept for activations when deciding whether the whole pipeline fits on the GPU
+OFFLOAD_HEADROOM_BYTES = int(float(os.getenv("OFFLOAD_HEADROOM_GB", "3")) * 1024 ** 3)
+
+# Seconds a GPU memory reading is reused by get_model_info
+MEMORY_SNAPSHOT_TTL = 1.0
+
+# Seconds between diffusion step progress reports
+PROGRESS_POLL_INTERVAL = float(os.getenv("PROGRESS_POLL_INTERVAL", "0.2"))
+
+# Minimum number of diffusion steps between progress reports
+PROGRESS_STEP_INTERVAL = max(1, int(os.getenv("PROGRESS_STEP_INTERVAL", "5")))
+
 class FluxService:
     def __init__(self):
         self.pipeline: Optional[FluxPipeline] = None
-        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = DEVICE
+        
+        if self.device == "cuda" and CUDA_MEM_FRACTION:
+            torch.cuda.set_per_process_memory_fraction(float(CUDA_MEM_FRACTION))
         self.is_loaded = False
-        self.model_id = os.getenv("MODEL_NAME", "black-forest-labs/FLUX.1-dev")
+        self.model_id = MODEL_NAME
+        self.is_schnell = "schnell" in self.model_id.lower()
+        self._executor: Optional[Executor] = None
+        
+        # torch.compile state: the denoiser is compiled per warmed-up (width, height)
+        self._denoiser_name: Optional[str] = None
+        self._eager_denoiser = None
+        self._compiled_denoiser = None
+        # (batch size, width, height) warmed up in the compiled graph
+        self._compiled_shapes: Set[Tuple[int, int, int]] = set()
+        self._eager_vae_decode = None
+        self._compiled_vae_decode = None
+        
+        # Peak activation bytes per output pixel observed so far, used to size batches to free VRAM
+        self._activation_bytes_per_pixel: Optional[float] = None
+        
+        # Page-locked host buffers for decoded images, one per (batch, height, width)
+        self._pinned_outputs: Dict[Tuple[int, int, int], torch.Tensor] = {}
+        
+        # Precompiled Neuron pipelines per (width, height) bucket
+        self._neuron_pipelines: Dict[Tuple[int, int], Any] = {}
+        
+        # (taken_at, allocated bytes) so status polling does not hit the CUDA allocator every call
+        self._memory_snapshot: Tuple[float, int] = (float("-inf"), 0)
+        
+        # (prompt, max_sequence_length) -> (prompt_embeds, pooled_prompt_embeds), least recently used first
+        self._embedding_cache: "OrderedDict[Tuple[str, int], Tuple[torch.Tensor, torch.Tensor]]" = OrderedDict()
+    
+    def set_executor(self, executor: Executor):
+        """Use a dedicated executor for pipeline calls instead of the loop's default pool"""
+        self._executor = executor
+        
+    async def initialize(self) -> bool:
+        """Load the model on the GPU executor without blocking the event loop"""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self.load_model)
+    
+    def _quantize_transformer(self):
+        """Quantize the FLUX transformer with torchao (FLUX_QUANTIZE=auto|fp8|int8|int4|none)"""
+        mode = FLUX_QUANTIZE
+        if mode in ("", "none", "bf16") or not hasattr(self.pipeline, "transformer"):
+            return
+        
+        if mode == "auto":
+            # FP8 tensor cores exist from Ada (sm_89) and Hopper (sm_90) on; CPUs get int8 weights,
+            # which quarters the bytes the memory-bound FP32 matmuls have to stream
+            if self.device == "cuda" and torch.cuda.get_device_capability() >= (8, 9):
+                mode = "fp8"
+            else:
+                mode = "int8"
+        
+        config_name = QUANTIZATION_CONFIGS.get(mode)
+        if config_name is None:
+            logger.warning(f"Unknown FLUX_QUANTIZE={mode}, keeping full-precision weights")
+            return
         
-    async def initialize(self):
-        """Initialize the AI model"""
         try:
-            # Login to HuggingFace if token is provided
-            hf_token = os.getenv("HUGGINGFACE_TOKEN")
-            if hf_token:
-                logger.info("Logging in to HuggingFace...")
-                login(token=hf_token)
-            
-            logger.info(f"Loading {self.model_id} model on {self.device}...")
-            
-            # Temporarily suppress verbose library logging during model loading
-            original_levels = {}
-            for lib_name in ["transformers", "diffusers", "accelerate", "torch", "huggingface_hub"]:
-                lib_logger = logging.getLogger(lib_name)
-                original_levels[lib_name] = lib_logger.level
-                lib_logger.setLevel(logging.ERROR)
-            
-            # Redirect stdout/stderr to suppress binary output during model loading
-            import sys
-            from io import StringIO
-            original_stdout = sys.stdout
-            original_stderr = sys.stderr
-            sys.stdout = StringIO()
-            sys.stderr = StringIO()
-            
-            # Load the pipeline
-            model_id = self.model_id
-            
+            from torchao import quantization
+        except ImportError:
+            logger.warning(f"FLUX_QUANTIZE={FLUX_QUANTIZE} resolved to {mode}, but torchao is not installed: "
+                           "keeping full-precision weights (pip install torchao)")
+            return
+        
+        try:
+            quantization.quantize_(self.pipeline.transformer, getattr(quantization, config_name)())
+            logger.info(f"Quantized FLUX transformer weights to {mode}")
+        except Exception as e:
+            logger.warning(f"Failed to quantize FLUX transformer to {mode}: {e}")
+    
+    def _enable_slicing(self):
+        """Chunk attention and VAE decode to cut peak memory on CPU and small GPUs (ATTENTION_SLICING=auto|enable|disable)"""
+        enabled = ATTENTION_SLICING == "enable"
+        if ATTENTION_SLICING == "auto":
+            enabled = self.device == "cpu" or torch.cuda.get_device_properties(0).total_memory <= SLICING_MAX_VRAM_BYTES
+        if not enabled:
+            return
+        
+        enabled_parts = []
+        # enable_attention_slicing silently skips components without set_attention_slice,
+        # which includes FluxTransformer2DModel, so only claim it where it applies
+        sliceable = [name for name, component in self.pipeline.components.items()
+                     if isinstance(component, torch.nn.Module) and hasattr(component, "set_attention_slice")]
+        if sliceable:
+            self.pipeline.enable_attention_slicing("auto")
+            enabled_parts.append(f"attention ({', '.join(sliceable)})")
+        
+        vae = getattr(self.pipeline, "vae", None)
+        if vae is not None and hasattr(vae, "enable_slicing"):
+            vae.enable_slicing()
+            enabled_parts.append("VAE decode")
+        
+        if enabled_parts:
+            logger.info(f"Slicing enabled for {' and '.join(enabled_parts)}")
+        else:
+            logger.warning("Slicing requested, but no component of this pipeline supports it")
+    
+    def _use_sdpa_attention(self):
+        """Route FLUX attention through PyTorch SDPA (flash / memory-efficient kernels); xformers breaks FLUX"""
+        torch.backends.cuda.enable_flash_sdp(True)
+        torch.backends.cuda.enable_mem_efficient_sdp(True)
+        
+        if not hasattr(self.pipeline, "transformer"):
+            return
+        try:
+            from diffusers.models.attention_processor import FluxAttnProcessor2_0
+            self.pipeline.transformer.set_attn_processor(FluxAttnProcessor2_0())
+        except ImportError:
+            logger.warning("FluxAttnProcessor2_0 not available, keeping the default attention processor")
+    
+    def _place_on_gpu(self) -> bool:
+        """Move the whole pipeline to the GPU when it fits, otherwise offload idle components to CPU.
+        
+        CPU_OFFLOAD=auto (default) moves the pipeline and keeps it there if OFFLOAD_HEADROOM_GB of VRAM
+        is still free, enable always offloads, disable never does. The footprint is measured after the
+        move because torchao's quantized tensors report their logical bf16 size, not their storage.
+        Model offload swaps whole components per stage; sequential offload is far too slow for FLUX.
+        Returns whether offload was enabled.
+        """
+        if getattr(self.pipeline, "hf_device_map", None):
+            logger.info(f"Pipeline loaded straight to GPU: {self.pipeline.hf_device_map}")
+            return False
+        
+        if CPU_OFFLOAD != "enable":
             try:
-                if model_id == "black-forest-labs/FLUX.1-dev":
-                    from diffusers import FluxPipeline
-                    
-                    # CPU optimizations for FLUX
-                    if self.device == "cpu":
-                        self.pipeline = FluxPipeline.from_pretrained(
-                            model_id,
-                            torch_dtype=torch.float32,
-                            use_safetensors=True,
-                            low_cpu_mem_usage=True
-                        )
-                    else:
-                        self.pipeline = FluxPipeline.from_pretrained(
-                            model_id,
-                            torch_dtype=torch.bfloat16,
-                            use_safetensors=True
-                        )
-                else:
-                    # Fallback to Stable Diffusion XL for development
-                    from diffusers import StableDiffusionXLPipeline
-                    self.pipeline = StableDiffusionXLPipeline.from_pretrained(
-                        "stabilityai/stable-diffusion-xl-base-1.0",
-                        torch_dtype=torch.float16 if self.device == "cuda" else torch.float32,
-                        use_safetensors=True
-                    )
-            except Exception as e:
-                logger.warning(f"Failed to load {model_id}, falling back to SDXL: {e}")
-                # Fallback to SDXL if FLUX fails
-                from diffusers import StableDiffusionXLPipeline
-                self.pipeline = StableDiffusionXLPipeline.from_pretrained(
-                    "stabilityai/stable-diffusion-xl-base-1.0",
-                    torch_dtype=torch.float16 if self.device == "cuda" else torch.float32,
-                    use_safetensors=True
-                )
-            
-            if self.device == "cuda":
                 self.pipeline = self.pipeline.to("cuda")
-                # Enable memory efficient attention if available
-                try:
-                    self.pipeline.enable_xformers_memory_efficient_attention()
-                except:
-                    logger.warning("xformers not available, using default attention")
-                
-                # Enable CPU offload for memory optimization
-                self.pipeline.enable_model_cpu_offload()
-            
-            self.is_loaded = True
-            
-            # Restore original stdout/stderr
-            sys.stdout = original_stdout
-            sys.stderr = original_stderr
-            
-            # Restore original logging levels
-            for lib_name, original_level in original_levels.items():
-                logging.getLogger(lib_name).setLevel(original_level)
-            
-            logger.info(f"{self.model_id} model loaded successfully")
-            return True
-            
+                free, _ = torch.cuda.mem_get_info()
+                logger.info(f"Pipeline uses {torch.cuda.memory_allocated() / 1024 ** 3:.1f}GB VRAM, "
+                            f"{free / 1024 ** 3:.1f}GB left free")
+                if CPU_OFFLOAD == "disable" or free >= OFFLOAD_HEADROOM_BYTES:
+                    return False
+                logger.warning("Too little VRAM left for activations, falling back to model CPU offload")
+            except torch.cuda.OutOfMemoryError:
+                logger.warning("Pipeline does not fit in VRAM, falling back to model CPU offload")
+            self.pipeline = self.pipeline.to("cpu")
+            torch.cuda.empty_cache()
+        
+        self.pipeline.enable_model_cpu_offload()
+        logger.info("Model CPU offload enabled")
+        return True
+    
+    @staticmethod
+    def _local_snapshot() -> Optional[str]:
+        """MODEL_PATH if it holds a diffusers snapshot; otherwise None and MODEL_NAME resolves from the Hub"""
+        if MODEL_PATH is None:
+            return None
+        # The instance store is wiped on stop and a download can die halfway: never fail over to SDXL for that
+        if not os.path.isfile(os.path.join(MODEL_PATH, "model_index.json")):
+            logger.warning(f"No model_index.json in MODEL_PATH={MODEL_PATH}, loading {MODEL_NAME} from the Hub")
+            return None
+        return MODEL_PATH
+    
+    def prefetch_weights(self) -> int:
+        """Start kernel readahead of cached safetensors so disk I/O overlaps model construction"""
+        if not hasattr(os, "posix_fadvise"):
+            return 0
+        
+        try:
+            model_dir = self._local_snapshot() or snapshot_download(self.model_id, local_files_only=True)
         except Exception as e:
-            logger.error(f"Failed to load {self.model_id} model: {e}")
-            return False
+            logger.info(f"No local snapshot of {self.model_id} to prefetch: {e}")
+            return 0
+        
+        # Only the component folders diffusers loads; the repo root also holds single-file checkpoints
+        try:
+            with open(os.path.join(model_dir, "model_index.json")) as index_file:
+                model_index = json.load(index_file)
+        except (OSError, ValueError) as e:
+            logger.info(f"Cannot read model_index.json in {model_dir}, skipping prefetch: {e}")
+            return 0
+        components = [name for name, spec in model_index.items()
+                      if not name.startswith("_") and isinstance(spec, list) and spec[0] is not None]
+        
+        prefetched = 0
+        for component in components:
+            for root, _, files in os.walk(os.path.join(model_dir, component)):
+                for name in files:
+                    if not name.endswith(".safetensors"):
+                        continue
+                    # Best effort: a dangling cache symlink or unreadable file must not abort startup
+                    try:
+                        fd = os.open(os.path.join(root, name), os.O_RDONLY)
+                        try:
+                            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+                            prefetched += 1
+                        finally:
+                            os.close(fd)
+                    except OSError as e:
+                        logger.info(f"Skipping prefetch of {name}: {e}")
+        
+        logger.info(f"Requested readahead for {prefetched} weight files in {model_dir}")
+        return prefetched
+    
+    def _load_neuron_pipeline(self):
+        """Load the ahead-of-time compiled FLUX pipeline of every size bucket; returns the smallest"""
+        from optimum.neuron import NeuronFluxPipeline
+        for width, height in NEURON_IMAGE_SIZES:
+            self._neuron_pipelines[(width, height)] = NeuronFluxPipeline.from_pretrained(
+                os.path.join(NEURON_MODEL_PATH, f"{width}x{height}")
+            )
+        return self._neuron_pipelines[NEURON_IMAGE_SIZES[0]]
+    
+    def _neuron_bucket(self, width: int, height: int) -> Tuple[int, int]:
+        """Smallest compiled size that covers width x height"""
+        for bucket_width, bucket_height in NEURON_IMAGE_SIZES:
+            if bucket_width >= width and bucket_height >= height:
+                return bucket_width, bucket_height
+        raise ValueError(f"No Neuron pipeline compiled for {width}x{height} or larger")
+    
+    @staticmethod
+    def _fit_to_size(image: Image.Image, width: int, height: int) -> Image.Image:
+        """Scale a bucket-sized image to cover width x height, then center-crop to it"""
+        scale = max(width / image.width, height / image.height)
+        image = image.resize((round(image.width * scale), round(image.height * scale)), Image.LANCZOS)
+        left = (image.width - width) // 2
+        top = (image.height - height) // 2
+        return image.crop((left, top, left + width, top + height))
+    
+    def _load_sdxl_fallback(self):
+        """Load the SDXL development fallback; diffusers resolves its pipeline module lazily on first use"""
+        from diffusers import StableDiffusionXLPipeline
+        return StableDiffusionXLPipeline.from_pretrained(
+            "stabilityai/stable-diffusion-xl-base-1.0",
+            torch_dtype=torch.float16 if self.device == "cuda" else torch.float32,
+            use_safetensors=True
+        )
     
     def load_model(self) -> bool:
-        """Synchronous wrapper for model loading (for eager loading)"""
+        """Load the model synchronously (eager loading at startup)"""
         try:
-            # Login to HuggingFace if token is provided
-            hf_token = os.getenv("HUGGINGFACE_TOKEN")
-            if hf_token:
-                logger.info("Logging in to HuggingFace...")
-                login(token=hf_token)
+            # Passed to from_pretrained instead of login(), which costs a /whoami round-trip on every start
+            hf_token = os.getenv("HUGGINGFACE_TOKEN") or None
             
             logger.info(f"Loading {self.model_id} model on {self.device}...")
             
@@ -137,56 +335,66 @@ class FluxService:
             sys.stderr = StringIO()
             
             # Load the pipeline
-            model_id = self.model_id
+            local_snapshot = self._local_snapshot()
+            model_id = local_snapshot or self.model_id
             
-            try:
-                if model_id == "black-forest-labs/FLUX.1-dev":
-                    from diffusers import FluxPipeline
-                    
-                    # CPU optimizations for FLUX
-                    if self.device == "cpu":
-                        self.pipeline = FluxPipeline.from_pretrained(
-                            model_id,
-                            torch_dtype=torch.float32,
-                            use_safetensors=True,
-                            low_cpu_mem_usage=True
-                        )
+            if self.device == "neuron":
+                # No fallback here: SDXL on the host CPU is not a usable substitute on Inferentia
+                self.pipeline = self._load_neuron_pipeline()
+            else:
+                try:
+                    if self.model_id.startswith("black-forest-labs/FLUX.1"):
+                        # CPU optimizations for FLUX
+                        if self.device == "cpu":
+                            self.pipeline = FluxPipeline.from_pretrained(
+                                model_id,
+                                torch_dtype=torch.float32,
+                                use_safetensors=True,
+                                token=hf_token,
+                                local_files_only=local_snapshot is not None,
+                                low_cpu_mem_usage=True
+                            )
+                        elif CPU_OFFLOAD == "disable":
+                            # Known to fit: stream shards straight into VRAM instead of staging a full copy in RAM
+                            self.pipeline = FluxPipeline.from_pretrained(
+                                model_id,
+                                torch_dtype=torch.bfloat16,
+                                use_safetensors=True,
+                                token=hf_token,
+                                local_files_only=local_snapshot is not None,
+                                device_map="balanced"
+                            )
+                        else:
+                            self.pipeline = FluxPipeline.from_pretrained(
+                                model_id,
+                                torch_dtype=torch.bfloat16,
+                                use_safetensors=True,
+                                token=hf_token,
+                                local_files_only=local_snapshot is not None,
+                                low_cpu_mem_usage=True
+                            )
                     else:
-                        self.pipeline = FluxPipeline.from_pretrained(
-                            model_id,
-                            torch_dtype=torch.bfloat16,
-                            use_safetensors=True,
-                            low_cpu_mem_usage=True
-                        )
-                else:
-                    # Fallback to Stable Diffusion XL for development
-                    from diffusers import StableDiffusionXLPipeline
-                    self.pipeline = StableDiffusionXLPipeline.from_pretrained(
-                        "stabilityai/stable-diffusion-xl-base-1.0",
-                        torch_dtype=torch.float16 if self.device == "cuda" else torch.float32,
-                        use_safetensors=True
-                    )
-            except Exception as e:
-                logger.warning(f"Failed to load {model_id}, falling back to SDXL: {e}")
-                # Fallback to SDXL if FLUX fails
-                from diffusers import StableDiffusionXLPipeline
-                self.pipeline = StableDiffusionXLPipeline.from_pretrained(
-                    "stabilityai/stable-diffusion-xl-base-1.0",
-                    torch_dtype=torch.float16 if self.device == "cuda" else torch.float32,
-                    use_safetensors=True
-                )
+                        # Fallback to Stable Diffusion XL for development
+                        self.pipeline = self._load_sdxl_fallback()
+                except Exception as e:
+                    logger.warning(f"Failed to load {model_id}, falling back to SDXL: {e}")
+                    # Fallback to SDXL if FLUX fails
+                    self.pipeline = self._load_sdxl_fallback()
+            
+            if self.device == "cpu":
+                self._quantize_transformer()
+                self._enable_slicing()
             
             if self.device == "cuda":
-                self.pipeline = self.pipeline.to("cuda")
-                # # Enable memory efficient attention if available
-                # try:
-                #     self.pipeline.enable_xformers_memory_efficient_attention()
-                # except:
-                #     logger.warning("xformers not available, using default attention")
+                self._quantize_transformer()
+                self._use_sdpa_attention()
+                # After the attention processor is set, so slicing is not overwritten
+                self._enable_slicing()
+                offloaded = self._place_on_gpu()
                 
-                # Enable CPU offload for memory optimization
-                if os.getenv("CPU_OFFLOAD") == "enable":
-                    self.pipeline.enable_model_cpu_offload()
+                # Offload hooks move weights between devices every stage, which defeats CUDA graphs
+                if TORCH_COMPILE and not offloaded:
+                    self._compile_denoiser()
             
             self.is_loaded = True
             
@@ -205,130 +413,323 @@ class FluxService:
             logger.error(f"Failed to load {self.model_id} model: {e}")
             return False
     
-    async def generate_image(self, request_data: Dict[str, Any], progress_callback=None) -> Dict[str, Any]:
-        """Generate an image from the request data"""
+    def _compile_denoiser(self):
+        """Compile the denoiser and VAE decoder and warm them up for each shape in COMPILE_WARMUP_SHAPES"""
+        self._denoiser_name = "transformer" if hasattr(self.pipeline, "transformer") else "unet"
+        self._eager_denoiser = getattr(self.pipeline, self._denoiser_name)
+        self._compiled_denoiser = torch.compile(self._eager_denoiser, mode="reduce-overhead", dynamic=False)
+        self._eager_vae_decode = self.pipeline.vae.decode
+        self._compiled_vae_decode = torch.compile(self._eager_vae_decode, dynamic=False)
+        
+        for shape in COMPILE_WARMUP_SHAPES.split(","):
+            width, height = (int(value) for value in shape.strip().split("x"))
+            if width * height > MAX_PIXELS:
+                logger.info(f"Skipping compile warmup for {width}x{height}, larger than MAX_PIXELS allows")
+                continue
+            logger.info(f"Warming up compiled {self._denoiser_name} for {width}x{height}...")
+            # Warmup runs one prompt; batches of other sizes would recompile, so they stay eager
+            self._compiled_shapes.add((1, width, height))
+            try:
+                # Two steps so the second denoiser call replays the captured CUDA graph
+                self._run_pipeline(
+                    prompt="warmup",
+                    width=width,
+                    height=height,
+                    num_inference_steps=2,
+                    # Must match generation, the text length is part of the compiled shape
+                    max_sequence_length=SCHNELL_MAX_SEQUENCE_LENGTH if self.is_schnell else 512
+                )
+            except Exception as e:
+                logger.warning(f"Compile warmup failed for {width}x{height}, using eager path: {e}")
+                self._compiled_shapes.discard((1, width, height))
+    
+    def _run_pipeline(self, **pipeline_kwargs):
+        """Run the diffusion pipeline synchronously"""
+        prompt = pipeline_kwargs.get("prompt")
+        images = len(prompt) if isinstance(prompt, list) else 1
+        
+        if self._compiled_denoiser is not None:
+            # Only warmed-up shapes use the compiled graph; with dynamic=False a new batch size or
+            # resolution would stall the request on a recompile and a fresh CUDA graph capture
+            shape = (images, pipeline_kwargs["width"], pipeline_kwargs["height"])
+            compiled = shape in self._compiled_shapes
+            setattr(self.pipeline, self._denoiser_name, self._compiled_denoiser if compiled else self._eager_denoiser)
+            self.pipeline.vae.decode = self._compiled_vae_decode if compiled else self._eager_vae_decode
+        
+        with torch.inference_mode():
+            self._apply_prompt_embeddings(pipeline_kwargs)
+            
+            if self._neuron_pipelines:
+                return self._neuron_pipelines[(pipeline_kwargs["width"], pipeline_kwargs["height"])](**pipeline_kwargs)
+            if self.device != "cuda":
+                return self.pipeline(**pipeline_kwargs)
+            
+            torch.cuda.reset_peak_memory_stats()
+            baseline = torch.cuda.memory_allocated()
+            result = self.pipeline(**pipeline_kwargs)
+        
+        pixels = pipeline_kwargs["width"] * pipeline_kwargs["height"] * images
+        bytes_per_pixel = (torch.cuda.max_memory_allocated() - baseline) / pixels
+        # Keep the worst case so batch sizing stays conservative
+        self._activation_bytes_per_pixel = max(self._activation_bytes_per_pixel or 0.0, bytes_per_pixel)
+        return result
+    
+    def _apply_prompt_embeddings(self, pipeline_kwargs: Dict[str, Any]):
+        """Replace prompt= with cached T5/CLIP embeddings so repeated prompts skip the text encoders"""
+        if PROMPT_CACHE_SIZE <= 0 or self.device == "neuron" or not isinstance(self.pipeline, FluxPipeline):
+            return
+        
+        prompts = pipeline_kwargs.pop("prompt")
+        if not isinstance(prompts, list):
+            prompts = [prompts]
+        max_sequence_length = pipeline_kwargs.get("max_sequence_length", 512)
+        
+        embeddings = [self._prompt_embeddings(prompt, max_sequence_length) for prompt in prompts]
+        pipeline_kwargs["prompt_embeds"] = torch.cat([prompt_embeds for prompt_embeds, _ in embeddings])
+        pipeline_kwargs["pooled_prompt_embeds"] = torch.cat([pooled for _, pooled in embeddings])
+    
+    def _prompt_embeddings(self, prompt: str, max_sequence_length: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Text-encoder outputs for one prompt, from the LRU cache when possible"""
+        key = (prompt, max_sequence_length)
+        cached = self._embedding_cache.get(key)
+        if cached is not None:
+            self._embedding_cache.move_to_end(key)
+            return cached
+        
+        prompt_embeds, pooled_prompt_embeds, _ = self.pipeline.encode_prompt(
+            prompt=prompt,
+            prompt_2=prompt,
+            num_images_per_prompt=1,
+            max_sequence_length=max_sequence_length
+        )
+        
+        if self.device == "cuda" and torch.cuda.mem_get_info()[0] < PROMPT_CACHE_MIN_FREE_MB * 1024 * 1024:
+            # Give VRAM back to activations: drop the older half of the cache
+            for _ in range(len(self._embedding_cache) // 2 + 1):
+                if not self._embedding_cache:
+                    break
+                self._embedding_cache.popitem(last=False)
+        
+        self._embedding_cache[key] = (prompt_embeds, pooled_prompt_embeds)
+        if len(self._embedding_cache) > PROMPT_CACHE_SIZE:
+            self._embedding_cache.popitem(last=False)
+        return prompt_embeds, pooled_prompt_embeds
+    
+    def _generate_images(self, **pipeline_kwargs) -> List[Union[Image.Image, bytes]]:
+        """Run the pipeline and return its images: PIL images, or on CUDA the already encoded bytes.
+        
+        On CUDA the output stays a tensor: it is converted to uint8 CHW on the GPU, copied into a
+        reused pinned buffer and encoded straight from it here, before the next call reuses the buffer.
+        """
+        if self.device != "cuda":
+            return self._run_pipeline(**pipeline_kwargs).images
+        
+        images = self._run_pipeline(output_type="pt", **pipeline_kwargs).images
+        images = images.clamp(0, 1).mul_(255).round_().to(torch.uint8)
+        
+        key = (images.shape[0], images.shape[2], images.shape[3])
+        pinned = self._pinned_outputs.get(key)
+        if pinned is None:
+            pinned = torch.empty(images.shape, dtype=torch.uint8, pin_memory=True)
+            self._pinned_outputs[key] = pinned
+        pinned.copy_(images, non_blocking=True)
+        torch.cuda.current_stream().synchronize()
+        
+        # Encoding on this thread finishes with the buffer before the next call can overwrite it,
+        # without a pageable copy per image
+        return [self._encode_image(image) for image in pinned]
+    
+    def batch_capacity(self, width: int, height: int) -> Optional[int]:
+        """How many width x height images fit in free VRAM at once, or None if unknown"""
+        if self.device != "cuda" or not self._activation_bytes_per_pixel:
+            return None
+        
+        free, _ = torch.cuda.mem_get_info()
+        # Memory the caching allocator holds but is not using is available to the next run too
+        free += torch.cuda.memory_reserved() - torch.cuda.memory_allocated()
+        return max(1, int(free * 0.9 // (self._activation_bytes_per_pixel * width * height)))
+    
+    @staticmethod
+    def _encode_image(image: Union[Image.Image, torch.Tensor]) -> bytes:
+        """Encode a generated image (PIL or uint8 CHW tensor) in IMAGE_FORMAT"""
+        if isinstance(image, torch.Tensor):
+            if IMAGE_FORMAT != "webp":
+                # Imported here: only the CUDA path produces tensors, and Neuron hosts have no torchvision
+                try:
+                    from torchvision.io import encode_png
+                except ImportError:
+                    pass
+                else:
+                    # libpng straight from the tensor, no PIL image in between
+                    return encode_png(image, compression_level=PNG_COMPRESS_LEVEL).numpy().tobytes()
+            image = Image.fromarray(image.permute(1, 2, 0).contiguous().numpy())
+        
+        buffer = io.BytesIO()
+        if IMAGE_FORMAT == "webp":
+            image.save(buffer, format="WEBP", quality=IMAGE_QUALITY, method=4)
+        else:
+            image.save(buffer, format="PNG", compress_level=PNG_COMPRESS_LEVEL)
+        return buffer.getvalue()
+    
+    async def generate_image(self, request: GenerationRequest, progress_callback=None) -> Dict[str, Any]:
+        """Generate an image for a single request"""
+        results = await self.generate_batch([request], [progress_callback])
+        return results[0]
+    
+    async def generate_batch(self, requests: List[GenerationRequest], progress_callbacks: List[Optional[Callable]]) -> List[Dict[str, Any]]:
+        """Generate one image per request in a single pipeline call.
+        
+        All requests must share width, height, guidance_scale and num_inference_steps.
+        """
         if not self.is_loaded or not self.pipeline:
             raise ValueError("Model not loaded")
         
+        def notify(progress: int, message: str):
+            for progress_callback in progress_callbacks:
+                if progress_callback:
+                    progress_callback(progress, message)
+        
         try:
-            prompt = request_data["prompt"]
-            width = request_data.get("width", 512)
-            height = request_data.get("height", 512)
-            guidance_scale = request_data.get("guidance_scale", 7.5)
-            num_inference_steps = request_data.get("num_inference_steps", 50)
-            seed = request_data.get("seed")
-            
-            if progress_callback:
-                progress_callback(10, "Setting up generation...")
-            
-            # Set seed for reproducibility
-            if seed is not None:
-                torch.manual_seed(seed)
-                if torch.cuda.is_available():
-                    torch.cuda.manual_seed(seed)
+            prompts = [request.prompt for request in requests]
+            seeds = [request.seed for request in requests]
+            width = requests[0].width
+            height = requests[0].height
+            guidance_scale = requests[0].guidance_scale
+            num_inference_steps = min(requests[0].num_inference_steps, MAX_INFERENCE_STEPS)
+            # Neuron graphs have fixed shapes: generate at the nearest compiled size and fit the result afterwards
+            pipeline_width, pipeline_height = self._neuron_bucket(width, height) if self.device == "neuron" else (width, height)
+            max_sequence_length = 512
+            if self.is_schnell:
+                num_inference_steps = min(num_inference_steps, SCHNELL_MAX_STEPS)
+                guidance_scale = 0.0
+                max_sequence_length = SCHNELL_MAX_SEQUENCE_LENGTH
+            
+            notify(10, "Setting up generation...")
+            
+            # One generator per request so seeds stay reproducible inside a batch
+            generators = []
+            for seed in seeds:
+                # Neuron pipelines draw their initial latents on the host
+                generator = torch.Generator(device="cpu" if self.device == "neuron" else self.device)
+                if seed is not None:
+                    generator.manual_seed(seed)
+                else:
+                    generator.seed()
+                generators.append(generator)
             
-            logger.info(f"Generating image with prompt: {prompt[:50]}...")
+            logger.info(f"Generating {len(prompts)} image(s) with prompt: {prompts[0][:50]}...")
             
             # Note: FLUX uses both CLIP (77 tokens) and T5-XXL (512 tokens) encoders
             # CLIP warnings about 77 token limit can be safely ignored
             # The T5 encoder will process the full prompt up to 512 tokens
             
-            if progress_callback:
-                progress_callback(20, "Starting diffusion process...")
+            notify(20, "Starting diffusion process...")
+            
+            # The step hook only records the step; progress is reported from the event loop
+            # so the diffusion thread never blocks on callbacks or network I/O
+            current_step = -1
             
-            # Create a progress callback for the pipeline
             def step_callback(pipe, step: int, timestep: int, callback_kwargs):
-                if progress_callback:
-                    # Temporarily restore stdout for our callback
-                    import sys
-                    current_stdout = sys.stdout
-                    current_stderr = sys.stderr
-                    if hasattr(self, '_original_stdout'):
-                        sys.stdout = self._original_stdout
-                        sys.stderr = self._original_stderr
-                    
-                    progress = 20 + int((step / num_inference_steps) * 70)  # 20% to 90%
-                    progress_callback(progress, f"Diffusion step {step}/{num_inference_steps}")
-                    
-                    # Restore suppression
-                    sys.stdout = current_stdout
-                    sys.stderr = current_stderr
+                nonlocal current_step
+                current_step = step
                 return callback_kwargs
             
+            async def report_steps():
+                reported_step = -1
+                while True:
+                    await asyncio.sleep(PROGRESS_POLL_INTERVAL)
+                    step = current_step
+                    if step <= reported_step:
+                        continue
+                    # First and last steps always go out; in between only every PROGRESS_STEP_INTERVAL steps
+                    if reported_step < 0 or step - reported_step >= PROGRESS_STEP_INTERVAL or step == num_inference_steps - 1:
+                        reported_step = step
+                        progress = 20 + int((step / num_inference_steps) * 70)  # 20% to 90%
+                        notify(progress, f"Diffusion step {step}/{num_inference_steps}")
+            
             # Generate the image with suppressed stdout/stderr
             import sys
             from io import StringIO
             original_stdout = sys.stdout
             original_stderr = sys.stderr
             
-            # Store original for callback access
-            self._original_stdout = original_stdout
-            self._original_stderr = original_stderr
-            
             # Suppress output during generation
             sys.stdout = StringIO()
             sys.stderr = StringIO()
             
+            reporter = asyncio.create_task(report_steps())
             try:
-                with torch.inference_mode():
-                    result = self.pipeline(
-                        prompt=prompt,
-                        width=width,
-                        height=height,
-                        guidance_scale=guidance_scale,
-                        num_inference_steps=num_inference_steps,
-                        max_sequence_length=512,
-                        callback_on_step_end=step_callback
-                    )
+                # Run the diffusion loop on the GPU executor
+                images = await asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(
+                    self._generate_images,
+                    prompt=prompts,
+                    width=pipeline_width,
+                    height=pipeline_height,
+                    guidance_scale=guidance_scale,
+                    num_inference_steps=num_inference_steps,
+                    max_sequence_length=max_sequence_length,
+                    generator=generators,
+                    callback_on_step_end=step_callback
+                ))
             finally:
+                reporter.cancel()
                 # Always restore output
                 sys.stdout = original_stdout
                 sys.stderr = original_stderr
-                
-                image = result.images[0]
             
-            if progress_callback:
-                progress_callback(95, "Converting image...")
+            if (pipeline_width, pipeline_height) != (width, height):
+                images = [self._fit_to_size(image, width, height) for image in images]
+            
+            notify(95, "Converting image...")
             
             try:
-                # Convert image to base64 for transmission
-                logger.info("Starting image conversion to base64...")
-                buffer = io.BytesIO()
-                image.save(buffer, format="PNG")
-                logger.info(f"Image saved to buffer, size: {buffer.tell()} bytes")
-                
-                image_b64 = base64.b64encode(buffer.getvalue()).decode()
-                logger.info(f"Image converted to base64, length: {len(image_b64)} characters")
+                # Encode once off the event loop; callers decide how to transmit the raw bytes.
+                # PIL releases the GIL while compressing, so a batch encodes in parallel
+                logger.info(f"Starting image conversion to {IMAGE_FORMAT.upper()}...")
+                if images and isinstance(images[0], bytes):
+                    # CUDA output was already encoded from the pinned buffer on the GPU thread
+                    encoded_images = images
+                else:
+                    encoded_images = await asyncio.gather(*(
+                        asyncio.to_thread(self._encode_image, image) for image in images
+                    ))
+                results = []
+                for image_bytes, prompt, seed in zip(encoded_images, prompts, seeds):
+                    logger.info(f"Image saved to buffer, size: {len(image_bytes)} bytes")
+                    
+                    results.append({
+                        "status": "completed",
+                        "image_bytes": image_bytes,
+                        "mime_type": f"image/{IMAGE_FORMAT}",
+                        "metadata": {
+                            "prompt": prompt,
+                            "width": width,
+                            "height": height,
+                            "guidance_scale": guidance_scale,
+                            "num_inference_steps": num_inference_steps,
+                            "seed": seed
+                        }
+                    })
                 
-                if progress_callback:
-                    progress_callback(100, "Image generation completed!")
+                notify(100, "Image generation completed!")
                 
                 logger.info("Image generation completed successfully")
                 
-                return {
-                    "status": "completed",
-                    "image_data": image_b64,
-                    "metadata": {
-                        "prompt": prompt,
-                        "width": width,
-                        "height": height,
-                        "guidance_scale": guidance_scale,
-                        "num_inference_steps": num_inference_steps,
-                        "seed": seed
-                    }
-                }
+                return results
             except Exception as e:
                 logger.error(f"Error during image conversion: {e}")
-                if progress_callback:
-                    progress_callback(95, f"Image conversion failed: {str(e)}")
+                notify(95, f"Image conversion failed: {str(e)}")
                 raise
             
         except Exception as e:
             logger.error(f"Error generating image: {e}")
-            return {
+            if self.device == "cuda":
+                # Release blocks left by a failed (often OOM) run before the next job
+                torch.cuda.empty_cache()
+            return [{
                 "status": "failed",
                 "error": str(e)
-            }
+            } for _ in requests]
     
     def get_model_info(self) -> Dict[str, Any]:
         """Get information about the loaded model"""
@@ -336,5 +737,18 @@ class FluxService:
             "model_name": self.model_id,
             "device": self.device,
             "is_loaded": self.is_loaded,
-            "memory_usage": torch.cuda.memory_allocated() if torch.cuda.is_available() else 0
-        }
\ No newline at end of file
+            "memory_usage": self._memory_usage(),
+            "neuron_buckets": [f"{width}x{height}" for width, height in self._neuron_pipelines]
+        }
+    
+    def _memory_usage(self) -> int:
+        """Allocated GPU memory, re-read at most every MEMORY_SNAPSHOT_TTL seconds"""
+        if self.device != "cuda":
+            return 0
+        
+        taken_at, allocated = self._memory_snapshot
+        now = time.monotonic()
+        if now - taken_at >= MEMORY_SNAPSHOT_TTL:
+            allocated = torch.cuda.memory_allocated()
+            self._memory_snapshot = (now, allocated)
+        return allocated
\ No newline at end of file
@@ -0,0 +1,136 @@
+import asyncio
+import logging
+import os
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from models.generation_request import GenerationRequest
+from services.flux_service import FluxService
+
+logger = logging.getLogger(__name__)
+
+class GenerationBatcher:
+    """Collects concurrent generation requests and runs compatible ones as one pipeline call"""
+
+    def __init__(self, flux_service: FluxService):
+        self.flux_service = flux_service
+        self.max_batch = max(1, int(os.getenv('MAX_BATCH', '1')))
+        self.max_wait = float(os.getenv('MAX_WAIT_MS', '50')) / 1000
+        # Requests waiting beyond this are refused instead of piling up behind the GPU (0 = unbounded)
+        self.max_queued = max(0, int(os.getenv('MAX_QUEUED', '100')))
+        self.queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        logger.info(f"Generation batcher initialized: max_batch={self.max_batch}, max_wait={self.max_wait}s, max_queued={self.max_queued}")
+
+    def start(self):
+        """Start the background batching loop"""
+        self.queue = asyncio.Queue(maxsize=self.max_queued)
+        self._task = asyncio.create_task(self._run())
+        self._task.add_done_callback(self._on_task_done)
+
+    @staticmethod
+    def _on_task_done(task: asyncio.Task):
+        """Make a dead batching loop loud; queued requests would otherwise wait forever"""
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            logger.error("Generation batcher loop died", exc_info=task.exception())
+        else:
+            logger.error("Generation batcher loop exited unexpectedly")
+
+    async def stop(self):
+        """Stop the batching loop"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def submit(self, request: GenerationRequest, progress_callback: Optional[Callable] = None) -> Dict[str, Any]:
+        """Queue a request and wait for its generation result; raises asyncio.QueueFull when the queue is at max_queued"""
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((request, progress_callback, future))
+        return await future
+
+    @staticmethod
+    def _batch_key(request: GenerationRequest) -> Tuple:
+        """Requests can share a pipeline call only if shapes and sampling settings match"""
+        return (request.width, request.height, request.num_inference_steps, request.guidance_scale)
+
+    async def _collect(self) -> List[Tuple]:
+        """Wait for one request, then gather more until max_batch or max_wait"""
+        loop = asyncio.get_running_loop()
+        items = [await self.queue.get()]
+
+        # Take everything already queued in one pass; only wait (one timer per get) for stragglers
+        while len(items) < self.max_batch and not self.queue.empty():
+            items.append(self.queue.get_nowait())
+
+        deadline = loop.time() + self.max_wait
+        while len(items) < self.max_batch:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                items.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        return items
+
+    async def _run(self):
+        """Main batching loop; an error fails the requests in hand but never stops the loop"""
+        while True:
+            items: List[Tuple] = []
+            try:
+                items = await self._collect()
+
+                groups: Dict[Tuple, List[Tuple]] = {}
+                for item in items:
+                    groups.setdefault(self._batch_key(item[0]), []).append(item)
+
+                for group in groups.values():
+                    capacity = self._capacity(group)
+                    if capacity < len(group):
+                        logger.info(f"Splitting batch of {len(group)} into chunks of {capacity} to fit free VRAM")
+                    for start in range(0, len(group), capacity):
+                        await self._run_group(group[start:start + capacity])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Generation batcher failed to process {len(items)} requests: {e}")
+                for _, _, future in items:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _capacity(self, group: List[Tuple]) -> int:
+        """How many of the group's requests fit in one pipeline call; the whole group if free VRAM cannot be read"""
+        request = group[0][0]
+        try:
+            # Back off to what fits in free VRAM, measured from previous runs
+            return self.flux_service.batch_capacity(request.width, request.height) or len(group)
+        except Exception as e:
+            logger.warning(f"Could not estimate batch capacity, running {len(group)} requests together: {e}")
+            return len(group)
+
+    async def _run_group(self, group: List[Tuple]):
+        """Generate a group of compatible requests and resolve their futures"""
+        requests = [item[0] for item in group]
+        progress_callbacks = [item[1] for item in group]
+
+        if len(group) > 1:
+            logger.info(f"Running batched generation for {len(group)} requests")
+
+        try:
+            results = await self.flux_service.generate_batch(requests, progress_callbacks)
+        except Exception as e:
+            logger.error(f"Batched generation failed: {e}")
+            for _, _, future in group:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, _, future), result in zip(group, results):
+            if not future.done():
+                future.set_result(result)
@@ -1,14 +1,30 @@
 import asyncio
-import json
 import time
 import logging
 import os
-import requests
+import httpx
 from typing import Optional
 from services.mqtt_client import get_mqtt_client
 
 logger = logging.getLogger(__name__)
 
+METADATA_URL = 'http://169.254.169.254/latest'
+
+# IMDSv2 session token lifetime requested, and how early it is renewed
+IMDS_TOKEN_TTL = 21600
+IMDS_TOKEN_RENEW_MARGIN = 60
+
+# Instance id, type and IPs rarely change; re-read them at most this often
+METADATA_CACHE_TTL = 300
+
+# Local /health result is reused for this long; /health answers in milliseconds, so 1s is a generous timeout
+SERVICE_STATUS_TTL = 10
+SERVICE_STATUS_TIMEOUT = 1.0
+
+# One monitor tick every MONITOR_INTERVAL seconds; while nothing changes, a heartbeat goes out every HEARTBEAT_TICKS ticks
+MONITOR_INTERVAL = 30
+HEARTBEAT_TICKS = 4
+
 class InstanceMonitor:
     def __init__(self):
         self.instance_id = os.getenv('EC2_INSTANCE_ID', 'unknown')
@@ -16,6 +32,19 @@ class InstanceMonitor:
         self.mqtt_client = None
         self.monitoring = False
         self.last_state = None
+        self._ticks_since_event = 0
+        
+        # Non-blocking pooled client for the metadata service (reused IMDSv2 token) and local health checks;
+        # the monitor shares the FastAPI event loop, so nothing here may block it
+        self._http = httpx.AsyncClient(timeout=2.0)
+        self._monitor_task: Optional[asyncio.Task] = None
+        self._imds_token: Optional[str] = None
+        self._imds_token_expires = 0.0
+        # Concurrent metadata reads share one token request instead of each PUTting their own
+        self._imds_token_lock = asyncio.Lock()
+        self._meta_cache: dict = {}
+        self._meta_cache_ts = 0.0
+        self._health_cache = (0.0, 'unknown')
         
     async def start_monitoring(self):
         """Start monitoring instance state and health"""
@@ -36,86 +65,106 @@ class InstanceMonitor:
             })
             
             # Start monitoring loop
-            asyncio.create_task(self.monitor_loop())
+            self._monitor_task = asyncio.create_task(self.monitor_loop())
             
         except Exception as e:
             logger.error(f"Failed to start instance monitoring: {e}")
     
     async def monitor_loop(self):
-        """Main monitoring loop"""
+        """Main monitoring loop: one state read per tick feeds the spot check, state change and heartbeat"""
         while self.monitoring:
             try:
-                # Check instance metadata and health
-                current_state = await self.get_instance_state()
-                
-                if current_state != self.last_state:
-                    await self.send_state_change(current_state)
-                    self.last_state = current_state
+                # Metadata, service health and the spot notice are read together, once per tick,
+                # after the IMDS token so the concurrent reads do not each request one
+                await self._get_imds_token()
+                current_state, spot_action = await asyncio.gather(
+                    self.get_instance_state(),
+                    self._get_metadata('spot/instance-action')
+                )
                 
-                # Send periodic heartbeat
-                await self.send_heartbeat()
+                await self.check_spot_interruption(spot_action)
                 
-                # Check for spot interruption
-                await self.check_spot_interruption()
+                # The timestamp differs every tick, so it is not part of the comparison
+                comparable_state = {key: value for key, value in current_state.items() if key != 'timestamp'}
+                if comparable_state != self.last_state:
+                    # A state change already tells subscribers the instance is alive
+                    await self.send_state_change(current_state)
+                    self.last_state = comparable_state
+                    self._ticks_since_event = 0
+                else:
+                    self._ticks_since_event += 1
+                    if self._ticks_since_event >= HEARTBEAT_TICKS:
+                        await self.send_heartbeat(current_state)
+                        self._ticks_since_event = 0
                 
-                await asyncio.sleep(30)  # Check every 30 seconds
+                await asyncio.sleep(MONITOR_INTERVAL)
                 
             except Exception as e:
                 logger.error(f"Error in monitoring loop: {e}")
                 await asyncio.sleep(60)  # Wait longer on error
     
+    async def _get_imds_token(self) -> Optional[str]:
+        """IMDSv2 session token, renewed shortly before it expires"""
+        if self._imds_token and time.time() < self._imds_token_expires - IMDS_TOKEN_RENEW_MARGIN:
+            return self._imds_token
+        async with self._imds_token_lock:
+            # Another reader may have renewed it while this one waited
+            if self._imds_token and time.time() < self._imds_token_expires - IMDS_TOKEN_RENEW_MARGIN:
+                return self._imds_token
+            return await self._request_imds_token()
+    
+    async def _request_imds_token(self) -> Optional[str]:
+        """PUT a new IMDSv2 session token"""
+        try:
+            response = await self._http.put(
+                f'{METADATA_URL}/api/token',
+                headers={'X-aws-ec2-metadata-token-ttl-seconds': str(IMDS_TOKEN_TTL)}
+            )
+            if response.status_code == 200:
+                self._imds_token = response.text
+                self._imds_token_expires = time.time() + IMDS_TOKEN_TTL
+                return self._imds_token
+        except httpx.HTTPError:
+            pass
+        return None
+    
+    async def _get_metadata(self, path: str) -> Optional[str]:
+        """Read one meta-data path; None if it does not exist or the service is unreachable"""
+        token = await self._get_imds_token()
+        headers = {'X-aws-ec2-metadata-token': token} if token else {}
+        try:
+            response = await self._http.get(f'{METADATA_URL}/meta-data/{path}', headers=headers)
+        except httpx.HTTPError:
+            return None
+        if response.status_code == 401:
+            # Token rejected (expired or instance restarted): fetch a new one next time
+            self._imds_token = None
+        return response.text if response.status_code == 200 else None
+    
     async def get_instance_state(self) -> dict:
         """Get current instance state from metadata"""
         try:
-            # Get instance metadata
-            metadata = {}
-            
-            # Instance ID from metadata service
-            try:
-                response = requests.get(
-                    'http://169.254.169.254/latest/meta-data/instance-id',
-                    timeout=2
+            if time.time() - self._meta_cache_ts >= METADATA_CACHE_TTL:
+                # One token, then all four reads in flight together
+                await self._get_imds_token()
+                instance_id, instance_type, public_ip, private_ip = await asyncio.gather(
+                    self._get_metadata('instance-id'),
+                    self._get_metadata('instance-type'),
+                    self._get_metadata('public-ipv4'),
+                    self._get_metadata('local-ipv4')
                 )
-                if response.status_code == 200:
-                    metadata['instance_id'] = response.text
-            except:
-                metadata['instance_id'] = self.instance_id
+                self._meta_cache = {
+                    'instance_id': instance_id or self.instance_id,
+                    'instance_type': instance_type or self.instance_type,
+                    'public_ip': public_ip,
+                    'private_ip': private_ip
+                }
+                self._meta_cache_ts = time.time()
             
-            # Instance type
-            try:
-                response = requests.get(
-                    'http://169.254.169.254/latest/meta-data/instance-type',
-                    timeout=2
-                )
-                if response.status_code == 200:
-                    metadata['instance_type'] = response.text
-            except:
-                metadata['instance_type'] = self.instance_type
-            
-            # Public IP
-            try:
-                response = requests.get(
-                    'http://169.254.169.254/latest/meta-data/public-ipv4',
-                    timeout=2
-                )
-                if response.status_code == 200:
-                    metadata['public_ip'] = response.text
-            except:
-                metadata['public_ip'] = None
-            
-            # Private IP
-            try:
-                response = requests.get(
-                    'http://169.254.169.254/latest/meta-data/local-ipv4',
-                    timeout=2
-                )
-                if response.status_code == 200:
-                    metadata['private_ip'] = response.text
-            except:
-                metadata['private_ip'] = None
+            metadata = dict(self._meta_cache)
             
             # Service health
-            metadata['service_status'] = self.get_service_status()
+            metadata['service_status'] = await self.get_service_status()
             metadata['timestamp'] = time.time()
             
             return metadata
@@ -129,28 +178,33 @@ class InstanceMonitor:
                 'timestamp': time.time()
             }
     
-    def get_service_status(self) -> str:
-        """Get AI service health status"""
+    async def get_service_status(self) -> str:
+        """Get AI service health status, cached for SERVICE_STATUS_TTL seconds"""
+        checked_at, status = self._health_cache
+        if time.time() - checked_at < SERVICE_STATUS_TTL:
+            return status
+        
         try:
             # Check if service is responding
-            response = requests.get('http://localhost:8000/health', timeout=5)
+            response = await self._http.get('http://localhost:8000/health', timeout=SERVICE_STATUS_TIMEOUT)
             if response.status_code == 200:
-                return 'healthy'
+                status = 'healthy'
             else:
-                return 'unhealthy'
+                status = 'unhealthy'
         except:
-            return 'unavailable'
+            status = 'unavailable'
+        
+        self._health_cache = (time.time(), status)
+        return status
     
-    async def check_spot_interruption(self):
-        """Check for spot interruption notice"""
+    async def check_spot_interruption(self, action: Optional[str] = None):
+        """Report a spot interruption notice; reads it from metadata unless the caller already did"""
         try:
-            response = requests.get(
-                'http://169.254.169.254/latest/meta-data/spot/instance-action',
-                timeout=2
-            )
-            if response.status_code == 200:
+            # Never cached: the notice is only issued two minutes ahead of the interruption
+            if action is None:
+                action = await self._get_metadata('spot/instance-action')
+            if action is not None:
                 # Spot interruption detected
-                action = response.text
                 logger.warning(f"Spot interruption detected: {action}")
                 
                 await self.send_instance_event('spot_interruption', {
@@ -159,9 +213,6 @@ class InstanceMonitor:
                     'notice_time': time.time()
                 })
                 
-        except requests.exceptions.RequestException:
-            # 404 means no interruption notice - this is normal
-            pass
         except Exception as e:
             logger.error(f"Error checking spot interruption: {e}")
     
@@ -169,12 +220,12 @@ class InstanceMonitor:
         """Send instance state change event"""
         await self.send_instance_event('state_change', state)
     
-    async def send_heartbeat(self):
-        """Send periodic heartbeat"""
+    async def send_heartbeat(self, state: Optional[dict] = None):
+        """Send periodic heartbeat, reusing the tick's state when given"""
+        service_status = state['service_status'] if state else await self.get_service_status()
         await self.send_instance_event('heartbeat', {
-            'instance_id': self.instance_id,
             'timestamp': time.time(),
-            'service_status': self.get_service_status()
+            'service_status': service_status
         })
     
     async def send_instance_event(self, event_type: str, data: dict):
@@ -192,7 +243,7 @@ class InstanceMonitor:
                 'data': data
             }
             
-            self.mqtt_client._publish_message(topic, message)
+            await self.mqtt_client.publish_async(topic, message)
             logger.debug(f"Sent instance event: {event_type}")
             
         except Exception as e:
@@ -204,7 +255,7 @@ class InstanceMonitor:
             'instance_id': self.instance_id,
             'instance_type': self.instance_type,
             'service_status': 'ready',
-            'public_ip': self.get_public_ip()
+            'public_ip': await self.get_public_ip()
         })
     
     async def send_service_stopping(self):
@@ -214,22 +265,19 @@ class InstanceMonitor:
             'timestamp': time.time()
         })
     
-    def get_public_ip(self) -> Optional[str]:
+    async def get_public_ip(self) -> Optional[str]:
         """Get public IP from metadata"""
-        try:
-            response = requests.get(
-                'http://169.254.169.254/latest/meta-data/public-ipv4',
-                timeout=2
-            )
-            if response.status_code == 200:
-                return response.text
-        except:
-            pass
-        return None
+        if 'public_ip' in self._meta_cache:
+            return self._meta_cache['public_ip']
+        return await self._get_metadata('public-ipv4')
     
-    def stop_monitoring(self):
+    async def stop_monitoring(self):
         """Stop instance monitoring"""
         self.monitoring = False
+        if self._monitor_task:
+            self._monitor_task.cancel()
+            self._monitor_task = None
+        await self._http.aclose()
         logger.info("Instance monitoring stopped")
 
 # Global instance monitor
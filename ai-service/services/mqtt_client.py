@@ -1,12 +1,27 @@
 import paho.mqtt.client as mqtt
-import json
+import orjson
+import asyncio
 import logging
 import os
-from datetime import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 from typing import Optional
 
 logger = logging.getLogger(__name__)
 
+PROGRESS_TOPIC = "fluxer/ai/progress/{}/{}"
+COMPLETED_TOPIC = "fluxer/ai/completed/{}/{}"
+ERROR_TOPIC = "fluxer/ai/error/{}/{}"
+
+# publish() takes paho's socket lock and can block on a slow broker (and the first call connects);
+# every async caller publishes through this one pool
+_publish_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="mqtt-publish")
+
+async def _run_in_publish_pool(func, *args):
+    """Run a blocking MQTT call on the publish pool"""
+    return await asyncio.get_running_loop().run_in_executor(_publish_pool, func, *args)
+
 class MqttClient:
     """MQTT client for sending AI service events"""
     
@@ -17,6 +32,8 @@ class MqttClient:
         self.username = os.getenv('MQTT_USERNAME')
         self.password = os.getenv('MQTT_PASSWORD')
         self.connected = False
+        # Set by _on_connect once the broker answers CONNACK, successfully or not
+        self._connect_event = threading.Event()
         
         # Set up authentication if provided
         if self.username and self.password:
@@ -27,6 +44,10 @@ class MqttClient:
         self.client.on_disconnect = self._on_disconnect
         self.client.on_publish = self._on_publish
         
+        # Let many QoS 1 messages be in flight and queue the rest instead of blocking publishers
+        self.client.max_inflight_messages_set(20)
+        self.client.max_queued_messages_set(1000)
+        
         logger.info(f"MQTT client initialized for {self.broker_host}:{self.broker_port}")
     
     def _on_connect(self, client, userdata, flags, rc):
@@ -37,6 +58,7 @@ class MqttClient:
         else:
             self.connected = False
             logger.error(f"Failed to connect to MQTT broker, return code {rc}")
+        self._connect_event.set()
     
     def _on_disconnect(self, client, userdata, rc):
         """Callback for when the client disconnects from the server"""
@@ -57,9 +79,9 @@ class MqttClient:
             self.client.connect(self.broker_host, self.broker_port, 60)
             self.client.loop_start()  # Start background thread for network activity
             
-            # Wait a bit for connection
-            import time
-            time.sleep(1)
+            # Return as soon as CONNACK arrives instead of sleeping a fixed second
+            if not self._connect_event.wait(timeout=5):
+                logger.warning("Timed out waiting for MQTT CONNACK")
             
             return self.connected
         except Exception as e:
@@ -71,15 +93,16 @@ class MqttClient:
         self.client.loop_stop()
         self.client.disconnect()
     
-    def _publish_message(self, topic: str, payload: dict) -> bool:
+    def _publish_message(self, topic: str, payload: dict, qos: int = 1) -> bool:
         """Publish a message to MQTT broker"""
         if not self.connected:
             logger.warning("MQTT client not connected, cannot publish message")
             return False
         
         try:
-            message = json.dumps(payload)
-            result = self.client.publish(topic, message, qos=1)
+            # paho accepts the bytes as-is; timestamps stay ISO strings ('Z'-suffixed) for consumers
+            message = orjson.dumps(payload, option=orjson.OPT_UTC_Z)
+            result = self.client.publish(topic, message, qos=qos)
             
             if result.rc == mqtt.MQTT_ERR_SUCCESS:
                 logger.debug(f"Published to {topic}: {payload}")
@@ -91,42 +114,54 @@ class MqttClient:
             logger.error(f"Error publishing MQTT message to {topic}: {e}")
             return False
     
-    def send_progress_update(self, job_id: str, user_id: str, progress: int, message: str) -> bool:
+    async def publish_async(self, topic: str, payload: dict, qos: int = 1) -> bool:
+        """Publish from the event loop without blocking it"""
+        return await _run_in_publish_pool(self._publish_message, topic, payload, qos)
+    
+    def send_progress_update(self, job_id: str, user_id: str, progress: int, message: str, seq: Optional[int] = None) -> bool:
         """Send progress update via MQTT"""
-        topic = f"fluxer/ai/progress/{user_id}/{job_id}"
+        topic = PROGRESS_TOPIC.format(user_id, job_id)
         payload = {
             'jobId': job_id,
             'userId': user_id,
             'progress': progress,
             'message': message,
-            'timestamp': datetime.utcnow().isoformat()
+            'timestamp': datetime.now(timezone.utc)
         }
-        return self._publish_message(topic, payload)
+        if seq is not None:
+            payload['seq'] = seq
+        # Fire-and-forget: a lost update is superseded by the next one, so no PUBACK round-trip
+        return self._publish_message(topic, payload, qos=0)
     
-    def send_completion_update(self, job_id: str, user_id: str) -> bool:
+    def send_completion_update(self, job_id: str, user_id: str, image_url: Optional[str] = None) -> bool:
         """Send completion update via MQTT (without image data)"""
-        topic = f"fluxer/ai/completed/{user_id}/{job_id}"
+        topic = COMPLETED_TOPIC.format(user_id, job_id)
         payload = {
             'jobId': job_id,
             'userId': user_id,
             'status': 'completed',
-            'timestamp': datetime.utcnow().isoformat()
+            'timestamp': datetime.now(timezone.utc)
         }
+        if image_url:
+            # Short reference only; data URLs would bloat every completion message
+            payload['imageUrl'] = image_url
         return self._publish_message(topic, payload)
     
     def send_error_update(self, job_id: str, user_id: str, error: str) -> bool:
         """Send error update via MQTT"""
-        topic = f"fluxer/ai/error/{user_id}/{job_id}"
+        topic = ERROR_TOPIC.format(user_id, job_id)
         payload = {
             'jobId': job_id,
             'userId': user_id,
             'error': error,
-            'timestamp': datetime.utcnow().isoformat()
+            'timestamp': datetime.now(timezone.utc)
         }
         return self._publish_message(topic, payload)
 
 # Global instance
 mqtt_client: Optional[MqttClient] = None
+# Publishes run on several pool threads; only one of them may create (and connect) the client
+_mqtt_client_lock = threading.Lock()
 
 def get_mqtt_client() -> Optional[MqttClient]:
     """Get or create MQTT client instance"""
@@ -138,32 +173,40 @@ def get_mqtt_client() -> Optional[MqttClient]:
         return None
     
     if mqtt_client is None:
-        mqtt_client = MqttClient()
-        if not mqtt_client.connect():
-            logger.warning("Failed to connect to MQTT broker")
-            mqtt_client = None
+        with _mqtt_client_lock:
+            # Two clients would share the fluxer-ai-<pid> id and keep kicking each other off the broker
+            if mqtt_client is None:
+                client = MqttClient()
+                if client.connect():
+                    mqtt_client = client
+                else:
+                    logger.warning("Failed to connect to MQTT broker")
+                    # Stop its network thread instead of leaking it
+                    client.disconnect()
     
     return mqtt_client
 
-def send_progress_update(job_id: str, user_id: str, progress: int, message: str) -> None:
-    """Convenience function to send progress update"""
+def send_progress_update(job_id: str, user_id: str, progress: int, message: str, seq: Optional[int] = None) -> bool:
+    """Convenience function to send progress update; returns whether it was delivered"""
     try:
         client = get_mqtt_client()
         if client:
-            success = client.send_progress_update(job_id, user_id, progress, message)
+            success = client.send_progress_update(job_id, user_id, progress, message, seq)
             if not success:
                 logger.warning(f"Failed to send MQTT progress update for job {job_id}")
+            return success
         else:
             logger.debug("MQTT client not available, skipping progress update")
     except Exception as e:
         logger.error(f"Error in send_progress_update: {e}")
+    return False
 
-def send_completion_update(job_id: str, user_id: str) -> None:
+def send_completion_update(job_id: str, user_id: str, image_url: Optional[str] = None) -> None:
     """Convenience function to send completion update (without image data)"""
     try:
         client = get_mqtt_client()
         if client:
-            success = client.send_completion_update(job_id, user_id)
+            success = client.send_completion_update(job_id, user_id, image_url)
             if not success:
                 logger.warning(f"Failed to send MQTT completion update for job {job_id}")
         else:
@@ -184,9 +227,37 @@ def send_error_update(job_id: str, user_id: str, error: str) -> None:
     except Exception as e:
         logger.error(f"Error in send_error_update: {e}")
 
+def publish_event(topic: str, payload: dict) -> bool:
+    """Publish an arbitrary event payload (e.g. lifecycle events); returns whether it was sent"""
+    try:
+        client = get_mqtt_client()
+        if client:
+            return client._publish_message(topic, payload)
+        logger.debug("MQTT client not available, skipping event")
+    except Exception as e:
+        logger.error(f"Error in publish_event: {e}")
+    return False
+
+async def publish_event_async(topic: str, payload: dict) -> bool:
+    """publish_event without blocking the event loop"""
+    return await _run_in_publish_pool(publish_event, topic, payload)
+
+async def send_progress_update_async(job_id: str, user_id: str, progress: int, message: str, seq: Optional[int] = None) -> bool:
+    """send_progress_update without blocking the event loop"""
+    return await _run_in_publish_pool(send_progress_update, job_id, user_id, progress, message, seq)
+
+async def send_completion_update_async(job_id: str, user_id: str, image_url: Optional[str] = None) -> None:
+    """send_completion_update without blocking the event loop"""
+    await _run_in_publish_pool(send_completion_update, job_id, user_id, image_url)
+
+async def send_error_update_async(job_id: str, user_id: str, error: str) -> None:
+    """send_error_update without blocking the event loop"""
+    await _run_in_publish_pool(send_error_update, job_id, user_id, error)
+
 def cleanup_mqtt():
     """Cleanup MQTT client on shutdown"""
     global mqtt_client
     if mqtt_client:
         mqtt_client.disconnect()
-        mqtt_client = None
\ No newline at end of file
+        mqtt_client = None
+    _publish_pool.shutdown(wait=False)
\ No newline at end of file
@@ -1,60 +1,73 @@
 #!/usr/bin/env python3
 
-import requests
+import httpx
 import json
 import time
 
+BASE_URL = "http://0.0.0.0:8000"
+
+def wait_until_ready(client: httpx.Client, max_wait: float = 600.0) -> bool:
+    """Poll /health with exponential backoff (100ms doubling to 5s) until the model is loaded"""
+    delay = 0.1
+    deadline = time.monotonic() + max_wait
+    while time.monotonic() < deadline:
+        try:
+            if client.get("/health").json().get("model_loaded"):
+                return True
+        except httpx.HTTPError:
+            pass
+        time.sleep(delay)
+        delay = min(delay * 2, 5.0)
+    return False
+
 # Test generate endpoint
 def test_generate():
-    url = "http://0.0.0.0:8000/generate"
-    
     payload = {
         "user_id": "test_user",
         "prompt": "A cute cat sitting on a table",
-        "width": 128,
-        "height": 128,
-        "guidance_scale": 7.5,
-        "num_inference_steps": 5,  # Reduced for faster testing
+        "width": 512,
+        "height": 512,
+        "guidance_scale": 3.5,
+        "num_inference_steps": 10,  # Smallest accepted, for faster testing
         "seed": 42
     }
-    
+
     print("Testing /generate endpoint...")
     print(f"Payload: {json.dumps(payload, indent=2)}")
-    
-    try:
-        response = requests.post(url, json=payload, timeout=30)
-        print(f"Status Code: {response.status_code}")
-        print(f"Response: {json.dumps(response.json(), indent=2)}")
-        
-        if response.status_code == 200:
-            job_data = response.json()
-            job_id = job_data.get("job_id")
-            
-            if job_id:
-                print(f"\nJob created: {job_id}")
-                print("Checking job status...")
-                
-                # Check job status
-                status_url = f"http://0.0.0.0:8000/job/{job_id}"
-                
-                for i in range(10):  # Check up to 10 times
-                    time.sleep(2)
-                    status_response = requests.get(status_url)
-                    status_data = status_response.json()
-                    
-                    print(f"Status check {i+1}: {status_data.get('status')}")
-                    
-                    if status_data.get('status') in ['completed', 'failed']:
-                        print(f"Final result: {json.dumps(status_data, indent=2)}")
-                        break
-                        
-        else:
-            print(f"Error: {response.text}")
-            
-    except requests.exceptions.RequestException as e:
-        print(f"Request failed: {e}")
-    except Exception as e:
-        print(f"Error: {e}")
+
+    # One client keeps a single keep-alive connection for every call; generation is synchronous and slow
+    with httpx.Client(base_url=BASE_URL, timeout=httpx.Timeout(600.0, connect=5.0)) as client:
+        try:
+            print("Waiting for the model to load...")
+            if not wait_until_ready(client):
+                print("Service did not become ready")
+                return
+
+            started = time.monotonic()
+            response = client.post("/generate", json=payload)
+            print(f"Status Code: {response.status_code} after {time.monotonic() - started:.1f}s")
+
+            if response.status_code != 200:
+                print(f"Error: {response.text}")
+                return
+
+            result = response.json()
+            image_url = result.get("image_url") or ""
+            # Keep multi-MB data URLs out of the console
+            if image_url.startswith("data:"):
+                result["image_url"] = f"{image_url[:40]}... ({len(image_url)} chars)"
+            print(f"Response: {json.dumps(result, indent=2)}")
+
+            # IMAGE_DELIVERY=url: fetch the image over the same connection
+            if image_url.startswith("/"):
+                image_response = client.get(image_url)
+                print(f"Image: {image_response.status_code}, {image_response.headers.get('content-type')}, "
+                      f"{len(image_response.content)} bytes")
+
+        except httpx.HTTPError as e:
+            print(f"Request failed: {e}")
+        except Exception as e:
+            print(f"Error: {e}")
 
 if __name__ == "__main__":
-    test_generate()
\ No newline at end of file
+    test_generate()
@@ -32,9 +32,9 @@ echo "Installing Neuron Python packages from official Neuron repository..."
 pip3 install --extra-index-url=https://pip.repos.neuron.amazonaws.com neuronx-cc torch-neuronx transformers
 
 # Install AI packages compatible with Neuron
-pip3 install diffusers fastapi uvicorn \
+pip3 install diffusers fastapi "uvicorn[standard]" \
     safetensors pillow requests boto3 paho-mqtt huggingface_hub protobuf \
-    sentencepiece python-dotenv accelerate
+    sentencepiece python-dotenv orjson httpx pybase64 accelerate
 
 echo "Neuron SDK and AI packages installed successfully"
 
@@ -51,6 +51,26 @@ git clone https://github.com/${GITHUB_REPO:-Sistemium/fluxer-claude}.git ai-serv
 cp -r ai-service-repo/ai-service /opt/ai-service || mkdir -p /opt/ai-service
 cd /opt/ai-service
 
+# Compile FLUX ahead of time for the NeuronCores, one export per WxH bucket (once per instance,
+# reused across restarts). Each bucket loads its own copy of the weights, so keep the list short.
+NEURON_MODEL_PATH=/opt/neuron/flux_neuron
+NEURON_IMAGE_SIZES=512x512
+pip3 install --extra-index-url=https://pip.repos.neuron.amazonaws.com optimum-neuron
+for NEURON_IMAGE_SIZE in ${NEURON_IMAGE_SIZES//,/ }; do
+    if [ ! -f "$NEURON_MODEL_PATH/$NEURON_IMAGE_SIZE/model_index.json" ]; then
+        echo "Exporting FLUX.1-dev to Neuron for $NEURON_IMAGE_SIZE (this takes a while)..."
+        HF_TOKEN=$HF_TOKEN HUGGINGFACE_HUB_CACHE=/opt/neuron/models optimum-cli export neuron \
+            --model black-forest-labs/FLUX.1-dev \
+            --batch_size 1 \
+            --auto_cast matmul \
+            --auto_cast_type bf16 \
+            --width ${NEURON_IMAGE_SIZE%x*} \
+            --height ${NEURON_IMAGE_SIZE#*x} \
+            "$NEURON_MODEL_PATH/$NEURON_IMAGE_SIZE" || echo "Neuron export for $NEURON_IMAGE_SIZE failed"
+    fi
+done
+chown -R ec2-user:ec2-user /opt/neuron
+
 # Set up environment for Inferentia2
 echo "Setting up environment variables for Inferentia2..."
 cat << EOF > /opt/ai-service.env
@@ -63,6 +83,8 @@ TORCH_HOME=/opt/neuron/cache
 NEURON_VISIBLE_CORES=1
 MODEL_NAME=black-forest-labs/FLUX.1-dev
 DEVICE_TYPE=neuron
+NEURON_MODEL_PATH=$NEURON_MODEL_PATH
+NEURON_IMAGE_SIZES=$NEURON_IMAGE_SIZES
 PYTORCH_NEURON_CACHE_PATH=/opt/neuron/cache
 EOF
 
@@ -184,32 +184,32 @@ if [ -d "/opt/dlami/nvme" ]; then
         if [ "$PYTHON_TYPE" = "conda" ]; then
             pip install --cache-dir /opt/dlami/nvme/pip-cache \
                 diffusers transformers accelerate \
-                fastapi uvicorn \
+                fastapi "uvicorn[standard]" \
                 safetensors pillow requests boto3 paho-mqtt huggingface_hub protobuf \
-                sentencepiece python-dotenv
+                sentencepiece python-dotenv orjson httpx pybase64 torchao
         else
             "$PYTHON_BASE/bin/pip" install --cache-dir /opt/dlami/nvme/pip-cache \
                 diffusers transformers accelerate \
-                fastapi uvicorn \
+                fastapi "uvicorn[standard]" \
                 safetensors pillow requests boto3 paho-mqtt huggingface_hub protobuf \
-                sentencepiece python-dotenv
+                sentencepiece python-dotenv orjson httpx pybase64 torchao
         fi
     else
         echo "No PyTorch environment found, using system python3..."
         pip3 install --cache-dir /opt/dlami/nvme/pip-cache \
             torch torchvision diffusers transformers accelerate \
-            fastapi uvicorn \
+            fastapi "uvicorn[standard]" \
             safetensors pillow requests boto3 paho-mqtt huggingface_hub protobuf \
-            sentencepiece python-dotenv
+            sentencepiece python-dotenv orjson httpx pybase64 torchao
     fi
     
     echo "Additional packages installed successfully"
 else
     echo "Warning: Instance store not found, installing to system"
     pip3 install torch torchvision diffusers transformers accelerate \
-        fastapi uvicorn \
+        fastapi "uvicorn[standard]" \
         safetensors pillow requests boto3 paho-mqtt huggingface_hub protobuf \
-        sentencepiece python-dotenv
+        sentencepiece python-dotenv orjson httpx pybase64 torchao
 fi
 
 # Clone AI service code from Git
@@ -219,6 +219,22 @@ git clone https://github.com/${GITHUB_REPO:-Sistemium/fluxer-claude}.git ai-serv
 cp -r ai-service-repo/ai-service /opt/ai-service || mkdir -p /opt/ai-service
 cd /opt/ai-service
 
+# Snapshot the weights once so the service loads them with local_files_only instead of
+# resolving every file against the Hub on each start
+MODEL_PATH=""
+if [ -d "/opt/dlami/nvme" ] && command -v huggingface-cli > /dev/null; then
+    echo "Downloading FLUX.1-dev snapshot to instance store..."
+    # The root single-file checkpoints (~24GB) are for other runtimes; diffusers reads the component folders
+    if HF_TOKEN=$HF_TOKEN huggingface-cli download black-forest-labs/FLUX.1-dev \
+        --exclude "flux1-dev.safetensors" "ae.safetensors" \
+        --local-dir /opt/dlami/nvme/models/flux-dev; then
+        chown -R ubuntu:ubuntu /opt/dlami/nvme/models
+        MODEL_PATH=/opt/dlami/nvme/models/flux-dev
+    else
+        echo "Warning: snapshot download failed, the service will resolve the model from the Hub"
+    fi
+fi
+
 # Set up environment - models cache to instance store, packages system
 echo "Setting up environment variables..."
 
@@ -240,6 +256,7 @@ HUGGINGFACE_HUB_CACHE=/opt/dlami/nvme/huggingface
 TORCH_HOME=/opt/dlami/nvme/torch-cache
 CUDA_VISIBLE_DEVICES=0
 MODEL_NAME=black-forest-labs/FLUX.1-dev
+MODEL_PATH=$MODEL_PATH
 EC2_INSTANCE_ID=$INSTANCE_ID
 EC2_INSTANCE_TYPE=$INSTANCE_TYPE
 MQTT_BROKER_HOST=$MQTT_HOST